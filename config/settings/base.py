@@ -26,6 +26,29 @@ WABA_SEND_MEDIA_CAPTION_SEPARATELY = env.bool("WABA_SEND_MEDIA_CAPTION_SEPARATEL
 
 BITRIX_OAUTH_URL = env("BITRIX_OAUTH_URL", default="https://oauth.bitrix24.tech")
 BITRIX_TEMP_FILE_BASE_URL = env("BITRIX_TEMP_FILE_BASE_URL", default="")
+# Keep-alive connections kept per Bitrix portal host, and number of hosts
+BITRIX_HTTP_POOL_MAXSIZE = env.int("BITRIX_HTTP_POOL_MAXSIZE", default=10)
+BITRIX_HTTP_MAX_HOSTS = env.int("BITRIX_HTTP_MAX_HOSTS", default=200)
+# Client-side limit of Bitrix REST requests per second per portal (0 disables)
+BITRIX_RATE_LIMIT = env.float("BITRIX_RATE_LIMIT", default=2.0)
+BITRIX_RATE_BURST = env.int("BITRIX_RATE_BURST", default=10)
+# Longest wait for a slot before the call fails with BitrixRateLimitError
+BITRIX_RATE_MAX_WAIT = env.float("BITRIX_RATE_MAX_WAIT", default=10.0)
+# The same outside Celery tasks, where the wait holds a request thread
+BITRIX_RATE_REQUEST_MAX_WAIT = env.float("BITRIX_RATE_REQUEST_MAX_WAIT", default=1.0)
+# Seconds of refill charged to the portal on QUERY_LIMIT_EXCEEDED
+BITRIX_RATE_PENALTY = env.float("BITRIX_RATE_PENALTY", default=2.0)
+BITRIX_RATE_LIMIT_RETRIES = env.int("BITRIX_RATE_LIMIT_RETRIES", default=3)
+# Failures in a row that open a portal's circuit (0 disables), and how long it stays open
+BITRIX_CIRCUIT_FAILURES = env.int("BITRIX_CIRCUIT_FAILURES", default=5)
+BITRIX_CIRCUIT_OPEN_SECONDS = env.int("BITRIX_CIRCUIT_OPEN_SECONDS", default=60)
+# Seconds call_method reuses the resolved portal users and credentials (0 disables)
+BITRIX_CREDENTIAL_CACHE_TTL = env.int("BITRIX_CREDENTIAL_CACHE_TTL", default=60)
+# Seconds an inbound event's app instance is cached per process (0 disables)
+BITRIX_APPINSTANCE_CACHE_TTL = env.int("BITRIX_APPINSTANCE_CACHE_TTL", default=60)
+# upd_refresh_token refreshes due credentials in chunks spread over this many seconds
+BITRIX_TOKEN_REFRESH_BATCH = env.int("BITRIX_TOKEN_REFRESH_BATCH", default=50)
+BITRIX_TOKEN_REFRESH_WINDOW = env.int("BITRIX_TOKEN_REFRESH_WINDOW", default=3600)
 OPENAI_API_BASE_URL = env("OPENAI_API_BASE_URL", default="https://api.openai.com")
 
 OLX_CHECK_ATTEMTS = env("OLX_CHECK_ATTEMTS", default=10)
@@ -386,6 +409,8 @@ CELERY_TASK_DEFAULT_QUEUE = "default"
 CELERY_QUEUES = (
     Queue('default'),
     Queue('bitrix'),
+    Queue('bitrix_messages'),
+    Queue('bitrix_calls'),
     Queue('olx'),
     Queue('waweb'),
     Queue('waba'),
@@ -0,0 +1,456 @@
+import argparse
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlencode
+
+import redis
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BASE_DIR not in sys.path:
+    sys.path.append(BASE_DIR)
+
+# Every key the benchmark writes starts with this prefix, so it never touches
+# the streams of a running buffer and can clean up after itself.
+KEY_PREFIX = "benchmark:webhook:"
+
+
+def buffer_env(args, upstream_url=""):
+    env = {
+        "WEBHOOK_BUFFER_REDIS_URL": args.redis_url,
+        "WEBHOOK_BUFFER_STREAM": f"{KEY_PREFIX}incoming",
+        "WEBHOOK_BUFFER_DEAD_STREAM": f"{KEY_PREFIX}dead",
+        "WEBHOOK_BUFFER_RETRY_ZSET": f"{KEY_PREFIX}retry",
+        "WEBHOOK_BUFFER_DEDUPE_PREFIX": f"{KEY_PREFIX}seen:",
+        "WEBHOOK_BUFFER_METRICS_PATH": "",
+        "WEBHOOK_FORWARD_METRICS_PORT": "0",
+        "WEBHOOK_FORWARD_URL": upstream_url,
+        "WEBHOOK_FORWARD_UNIX_SOCKET": "",
+        "WEBHOOK_FORWARD_GROUP": "benchmark",
+        "WEBHOOK_FORWARD_SHARDS": "",
+        "WEBHOOK_DISPATCH_MODE": "http",
+    }
+    return env
+
+
+def clear_keys(redis_client):
+    keys = list(redis_client.scan_iter(match=f"{KEY_PREFIX}*", count=1000))
+    for start in range(0, len(keys), 1000):
+        redis_client.delete(*keys[start:start + 1000])
+
+
+def bitrix_payload(number, tenant):
+    fields = {
+        "event": "ONIMCONNECTORMESSAGEADD",
+        "data[CONNECTOR]": "benchmark",
+        "data[LINE]": "1",
+        "data[MESSAGES][0][im][chat_id]": str(1000 + number % 50),
+        "data[MESSAGES][0][im][message_id]": str(number),
+        "data[MESSAGES][0][message][id]": str(number),
+        "data[MESSAGES][0][message][text]": f"Benchmark message {number}",
+        "data[MESSAGES][0][chat][id]": f"chat-{number % 50}",
+        "ts": str(int(time.time())),
+        "auth[domain]": f"portal-{tenant}.bitrix24.com",
+        "auth[client_endpoint]": f"https://portal-{tenant}.bitrix24.com/rest/",
+        "auth[server_endpoint]": "https://oauth.bitrix.info/rest/",
+        "auth[member_id]": f"member{tenant:028d}",
+        "auth[application_token]": f"token{tenant:027d}",
+    }
+    return (
+        "/api/bitrix/",
+        "application/x-www-form-urlencoded",
+        urlencode(fields).encode(),
+    )
+
+
+def waba_payload(number, tenant):
+    phone_id = f"10{tenant:013d}"
+    data = {
+        "object": "whatsapp_business_account",
+        "entry": [
+            {
+                "id": f"20{tenant:013d}",
+                "changes": [
+                    {
+                        "field": "messages",
+                        "value": {
+                            "messaging_product": "whatsapp",
+                            "metadata": {
+                                "display_phone_number": "15550000000",
+                                "phone_number_id": phone_id,
+                            },
+                            "contacts": [
+                                {
+                                    "profile": {"name": "Benchmark"},
+                                    "wa_id": f"1555{number % 10000:07d}",
+                                }
+                            ],
+                            "messages": [
+                                {
+                                    "from": f"1555{number % 10000:07d}",
+                                    "id": f"wamid.benchmark.{uuid.uuid4().hex}",
+                                    "timestamp": str(int(time.time())),
+                                    "type": "text",
+                                    "text": {"body": f"Benchmark message {number}"},
+                                }
+                            ],
+                        },
+                    }
+                ],
+            }
+        ],
+    }
+    return "/api/waba/", "application/json", json.dumps(data).encode()
+
+
+def build_events(count, args):
+    rng = random.Random(args.seed)
+    events = []
+    for number in range(count):
+        tenant = rng.randrange(args.tenants)
+        if rng.random() < args.waba_share:
+            events.append(waba_payload(number, tenant))
+        else:
+            events.append(bitrix_payload(number, tenant))
+    return events
+
+
+def make_environ(event_id, event):
+    path, content_type, body = event
+    return {
+        "REQUEST_METHOD": "POST",
+        "PATH_INFO": path,
+        "QUERY_STRING": "",
+        "CONTENT_TYPE": content_type,
+        "CONTENT_LENGTH": str(len(body)),
+        "HTTP_HOST": "benchmark.local",
+        "HTTP_X_BENCHMARK_ID": str(event_id),
+        "HTTP_X_BENCHMARK_SENT": repr(time.time()),
+        "wsgi.input": io.BytesIO(body),
+    }
+
+
+def post(application, event_id, event):
+    status = []
+    started = time.monotonic()
+    b"".join(
+        application(
+            make_environ(event_id, event),
+            lambda value, headers: status.append(value),
+        )
+    )
+    return status[0], time.monotonic() - started
+
+
+def ingest(application, events, clients, rate=0.0):
+    # Feeds the events through the WSGI app from `clients` threads, paced to
+    # `rate` events/s when it is set.
+    started = time.monotonic()
+
+    def send(event_id):
+        if rate:
+            delay = started + event_id / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        return post(application, event_id, events[event_id])
+
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        results = list(executor.map(send, range(len(events))))
+    return results, time.monotonic() - started
+
+
+class Upstream:
+    # Stub of the Django app: answers after `latency` seconds and fails a
+    # share of the requests with a 500, recording when each event arrived.
+
+    def __init__(self, latency, jitter, error_rate):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.received = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.expected = 0
+
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                upstream.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        # Keep-alive connections are reset when the worker stops.
+        self.server.handle_error = lambda request, client_address: None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self, expected):
+        self.expected = expected
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, request):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        failed = random.random() < self.error_rate
+        if not failed:
+            self.record(request.headers)
+
+        body = b"error" if failed else b"ok"
+        request.send_response(500 if failed else 200)
+        request.send_header("Content-Type", "text/plain")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def record(self, headers):
+        received_at = time.time()
+        event_id = headers.get("X-Benchmark-Id")
+        sent_at = float(headers.get("X-Benchmark-Sent") or received_at)
+        with self.lock:
+            self.requests += 1
+            # A redelivered event keeps its first arrival.
+            if event_id not in self.received:
+                self.received[event_id] = (sent_at, received_at)
+            if len(self.received) >= self.expected:
+                self.done.set()
+
+
+def percentile(values, share):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(share * len(ordered))) - 1))
+    return ordered[index]
+
+
+def used_memory(redis_client):
+    return int(redis_client.info("memory")["used_memory"])
+
+
+def measure_memory(args, application, redis_client):
+    # Buffers a sample with no worker running, so the growth of used_memory
+    # is what the stream (and dedupe markers) hold per buffered webhook.
+    sample = build_events(args.memory_sample, args)
+    before = used_memory(redis_client)
+    ingest(application, sample, args.clients)
+    growth = used_memory(redis_client) - before
+    clear_keys(redis_client)
+    return growth * 10000 / len(sample)
+
+
+def start_worker(args, upstream_url):
+    env = {**os.environ, **buffer_env(args, upstream_url)}
+    output = None if args.verbose else subprocess.DEVNULL
+    return subprocess.Popen(
+        [sys.executable, "-m", "separator.webhook_buffer.worker"],
+        cwd=BASE_DIR,
+        env=env,
+        stdout=output,
+        stderr=output,
+    )
+
+
+def run(args):
+    # The buffer modules read their settings at import time.
+    os.environ.update(buffer_env(args))
+    from separator.webhook_buffer import wsgi
+
+    redis_client = redis.Redis.from_url(args.redis_url)
+    redis_client.ping()
+    clear_keys(redis_client)
+
+    memory_per_10k = None
+    if args.memory_sample:
+        memory_per_10k = measure_memory(args, wsgi.application, redis_client)
+
+    events = build_events(args.events, args)
+    upstream = Upstream(args.latency / 1000.0, args.jitter / 1000.0, args.error_rate)
+    upstream.start(len(events))
+    worker = start_worker(args, upstream.url)
+    try:
+        # Let the worker create its stream groups before the first webhook.
+        time.sleep(args.warmup)
+        started = time.time()
+        responses, ingest_seconds = ingest(
+            wsgi.application, events, args.clients, args.rate
+        )
+        accepted = sum(1 for status, _ in responses if status.startswith("202"))
+        upstream.expected = accepted
+        if len(upstream.received) >= accepted:
+            upstream.done.set()
+        upstream.done.wait(args.timeout)
+        finished = time.time()
+    finally:
+        worker.terminate()
+        worker.wait()
+        upstream.stop()
+
+    with upstream.lock:
+        received = dict(upstream.received)
+        forward_requests = upstream.requests
+    dead = redis_client.xlen(f"{KEY_PREFIX}dead")
+    clear_keys(redis_client)
+
+    latencies = [arrived - sent for sent, arrived in received.values()]
+    last_arrival = max((arrived for _, arrived in received.values()), default=finished)
+    elapsed = max(last_arrival - started, 1e-9)
+    ingest_times = [seconds for _, seconds in responses]
+    return {
+        "events": len(events),
+        "accepted": accepted,
+        "delivered": len(received),
+        "dead": dead,
+        "duplicate_deliveries": forward_requests - len(received),
+        "events_per_second": len(received) / elapsed,
+        "ingest_events_per_second": len(events) / ingest_seconds,
+        "ingest_p50_ms": percentile(ingest_times, 0.50) * 1000,
+        "ingest_p99_ms": percentile(ingest_times, 0.99) * 1000,
+        "latency_p50_ms": percentile(latencies, 0.50) * 1000,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1000,
+        "redis_bytes_per_10k_events": memory_per_10k,
+    }
+
+
+def report(result):
+    print(f"events               {result['events']}")
+    print(f"accepted             {result['accepted']}")
+    print(f"delivered            {result['delivered']}")
+    print(f"dead                 {result['dead']}")
+    print(f"duplicate deliveries {result['duplicate_deliveries']}")
+    print(f"throughput           {result['events_per_second']:.1f} events/s")
+    print(f"ingest throughput    {result['ingest_events_per_second']:.1f} events/s")
+    print(
+        f"ingest latency       p50 {result['ingest_p50_ms']:.2f} ms, "
+        f"p99 {result['ingest_p99_ms']:.2f} ms"
+    )
+    print(
+        f"end-to-end latency   p50 {result['latency_p50_ms']:.1f} ms, "
+        f"p99 {result['latency_p99_ms']:.1f} ms"
+    )
+    if result["redis_bytes_per_10k_events"] is not None:
+        megabytes = result["redis_bytes_per_10k_events"] / 1024 / 1024
+        print(f"redis memory         {megabytes:.2f} MiB per 10k events")
+
+
+def compare(result, baseline, tolerance):
+    # Higher is better for throughput, lower is better for the rest.
+    checks = [
+        ("events_per_second", 1),
+        ("latency_p50_ms", -1),
+        ("latency_p99_ms", -1),
+        ("redis_bytes_per_10k_events", -1),
+    ]
+    failures = []
+    for name, direction in checks:
+        current, previous = result.get(name), baseline.get(name)
+        if current is None or not previous:
+            continue
+        change = (current - previous) / previous
+        if change * direction < -tolerance:
+            failures.append(f"{name}: {previous:.2f} -> {current:.2f} ({change:+.1%})")
+    if result["delivered"] < result["accepted"]:
+        failures.append(
+            f"delivered {result['delivered']} of {result['accepted']} accepted events"
+        )
+    return failures
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Benchmark the webhook buffer: feed synthetic Bitrix and Meta "
+            "webhooks through the WSGI endpoint and a worker into a stub "
+            "upstream. WEBHOOK_* environment variables other than the key "
+            "names, upstream and metrics settings apply as usual."
+        )
+    )
+    parser.add_argument(
+        "--redis-url",
+        default="redis://127.0.0.1:6381/15",
+        help="Redis to benchmark against; keys use the benchmark:webhook: prefix.",
+    )
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument(
+        "--rate", type=float, default=0.0, help="Ingress events per second (0: max)."
+    )
+    parser.add_argument("--tenants", type=int, default=20)
+    parser.add_argument(
+        "--waba-share", type=float, default=0.5, help="Share of Meta payloads."
+    )
+    parser.add_argument(
+        "--latency", type=float, default=20.0, help="Upstream latency in ms."
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.0, help="Extra random upstream latency in ms."
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="Share of upstream 500s."
+    )
+    parser.add_argument(
+        "--memory-sample",
+        type=int,
+        default=10000,
+        help="Webhooks buffered to measure Redis memory (0: skip).",
+    )
+    parser.add_argument("--warmup", type=float, default=1.0)
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=300.0,
+        help="Seconds to wait for delivery after the ingress finished.",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the result as JSON to this file.")
+    parser.add_argument("--baseline", help="Fail on a regression against this JSON.")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--verbose", action="store_true", help="Show worker logs.")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    result = run(args)
+    report(result)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(result, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        failures = compare(result, baseline, args.tolerance)
+        for failure in failures:
+            print(f"regression: {failure}")
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
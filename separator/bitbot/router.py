@@ -5,6 +5,7 @@ import requests
 from celery import shared_task
 from django.utils import timezone
 from separator.bitrix.crest import call_method
+from separator.bitrix.payload import parse_event
 from dify_client import ChatClient, WorkflowClient
 from dify_client.exceptions import DifyClientError, ValidationError
 from django.conf import settings
@@ -15,39 +16,36 @@ redis_client = redis.StrictRedis.from_url(settings.REDIS_URL)
 
 
 def extract_values(data, keys):
+    payload = parse_event(data)
     result = {}
     for search_key in keys:
-        if search_key in data:
-            result[search_key] = data[search_key]
-            continue
-        for key in data:
-            if key.endswith(f'[{search_key}]'):
-                result[search_key] = data[key]
-                break
+        if search_key in payload:
+            result[search_key] = payload[search_key]
+        elif search_key in payload.leaves:
+            result[search_key] = payload.leaves[search_key]
     return result
 
 def extract_files(data):
-    files = {}
-    for key, value in data.items():
-        if key.startswith('data[PARAMS][FILES]['):
-            try:
-                # key format: data[PARAMS][FILES][<id>][<prop>]...
-                parts = key.split('][')
-                if len(parts) >= 4:
-                    file_id = parts[2]
-                    prop = parts[3].replace(']', '')
-                    
-                    if file_id not in files:
-                        files[file_id] = {'id': file_id}
-                    
-                    if prop in ['name', 'type', 'size', 'extension']:
-                        files[file_id][prop] = value
-                    elif key.endswith('[viewerType]'):
-                        # Extract viewerType from viewerAttrs
-                        files[file_id]['viewerType'] = value
-            except Exception:
-                continue
-    return list(files.values())
+    files = []
+    # data[PARAMS][FILES][<id>][<prop>]...
+    items = parse_event(data).get_path("data", "PARAMS", "FILES", default={})
+    if not isinstance(items, dict):
+        return files
+    for file_id, item in items.items():
+        if not isinstance(item, dict):
+            continue
+        file = {'id': file_id}
+        for prop in ['name', 'type', 'size', 'extension']:
+            if prop in item:
+                file[prop] = item[prop]
+        viewer_attrs = item.get('viewerAttrs')
+        if 'viewerType' in item:
+            file['viewerType'] = item['viewerType']
+        elif isinstance(viewer_attrs, dict) and 'viewerType' in viewer_attrs:
+            # Extract viewerType from viewerAttrs
+            file['viewerType'] = viewer_attrs['viewerType']
+        files.append(file)
+    return files
 
 def send_command_answer(chatbot, command_id, message_id, text):
     if chatbot and command_id and message_id:
@@ -68,13 +66,8 @@ def send_message(chatbot, bot_id, dialog_id, text, system="N"):
 
 
 def get_bot_id(data):
-    bot_id = data.get("data[PARAMS][BOT_ID]")
-    if bot_id:
-        return bot_id
-    for key, value in data.items():
-        if key.endswith("[BOT_ID]"):
-            return value
-    return None
+    payload = parse_event(data)
+    return payload.get("data[PARAMS][BOT_ID]") or payload.leaves.get("BOT_ID")
 
 
 def get_application_token(data):
@@ -224,6 +217,7 @@ def flush_buffered_events(buffer_prefix, version):
 
 @shared_task(queue='bitbot')
 def event_processor(data):
+    data = parse_event(data)
     batch_delay = get_batch_delay(data)
     if batch_delay > 0 and should_buffer_event(data, batch_delay=batch_delay):
         return enqueue_buffered_event(data, batch_delay)
@@ -236,6 +230,7 @@ def process_event_payload(data):
     bot_id = None
     dialog_id = None
     chatbot = None
+    data = parse_event(data)
     try:
         member_id = data.get("auth[member_id]")
         application_token = get_application_token(data)
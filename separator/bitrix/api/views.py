@@ -17,7 +17,7 @@ class PortalViewSet(CreateModelMixin, GenericViewSet):
     permission_classes = [AllowAny]
 
     def create(self, request, *args, **kwargs):
-        utils.event_processor.delay(request.data)
+        utils.dispatch_event(request.data)
         return Response("ok")
 
     def head(self, request, *args, **kwargs):
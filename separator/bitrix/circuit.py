@@ -0,0 +1,134 @@
+import logging
+import time
+
+import redis
+from django.conf import settings
+
+from .ratelimit import is_limit_response
+
+logger = logging.getLogger("django")
+
+redis_client = redis.StrictRedis.from_url(settings.REDIS_URL)
+
+KEY_PREFIX = "bitrix:circuit:"
+
+# Counts a failed call. The circuit opens after BITRIX_CIRCUIT_FAILURES
+# failures in a row, or at once when the failed call was the half-open probe.
+RECORD_FAILURE = """
+local probing = redis.call("DEL", KEYS[2]) == 1
+local failures = redis.call("HINCRBY", KEYS[1], "failures", 1)
+if probing or failures >= tonumber(ARGV[1]) then
+    redis.call("HSET", KEYS[1], "open_until", tonumber(ARGV[3]) + tonumber(ARGV[2]))
+end
+redis.call("EXPIRE", KEYS[1], math.ceil(tonumber(ARGV[2]) * 2))
+return failures
+"""
+
+record_failure_script = redis_client.register_script(RECORD_FAILURE)
+
+
+# Returned by allow() to the caller let through as the half-open probe.
+PROBE = "probe"
+
+
+class BitrixCircuitOpenError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _circuit_keys(portal):
+    key = f"{KEY_PREFIX}{portal.member_id or portal.domain}"
+    return key, f"{key}:probe"
+
+
+def allow(portal):
+    # Raises BitrixCircuitOpenError while the portal's circuit is open. Once
+    # BITRIX_CIRCUIT_OPEN_SECONDS have passed, one caller at a time is let
+    # through as a probe and gets PROBE back. Otherwise returns whether the
+    # portal has any recorded failures, so a success only has to reset what
+    # exists.
+    if not settings.BITRIX_CIRCUIT_FAILURES:
+        return False
+    key, probe_key = _circuit_keys(portal)
+    try:
+        failures, open_until = redis_client.hmget(key, "failures", "open_until")
+        if not open_until:
+            return failures is not None
+
+        remaining = float(open_until) - time.time()
+        if remaining <= 0 and redis_client.set(
+            probe_key, 1, nx=True, ex=settings.BITRIX_CIRCUIT_OPEN_SECONDS
+        ):
+            return PROBE
+    except redis.exceptions.RedisError as exc:
+        # The breaker must not take Bitrix calls down with Redis.
+        logger.warning(f"Bitrix circuit breaker unavailable: {exc}")
+        return False
+
+    raise BitrixCircuitOpenError(
+        f"Circuit open for portal {portal.domain}",
+        retry_after=max(remaining, 1),
+    )
+
+
+def record_failure(portal):
+    if not settings.BITRIX_CIRCUIT_FAILURES:
+        return
+    try:
+        record_failure_script(
+            keys=list(_circuit_keys(portal)),
+            args=[
+                settings.BITRIX_CIRCUIT_FAILURES,
+                settings.BITRIX_CIRCUIT_OPEN_SECONDS,
+                time.time(),
+            ],
+        )
+    except redis.exceptions.RedisError as exc:
+        logger.warning(f"Bitrix circuit breaker unavailable: {exc}")
+
+
+def release(portal, tracked):
+    # Hands the probe back when the probe caller gives up before calling the
+    # portal, e.g. on the rate limit, so the next caller can probe instead of
+    # waiting for the probe key to expire.
+    if tracked != PROBE:
+        return
+    try:
+        redis_client.delete(_circuit_keys(portal)[1])
+    except redis.exceptions.RedisError as exc:
+        logger.warning(f"Bitrix circuit breaker unavailable: {exc}")
+
+
+def trip(portal):
+    # Opens the circuit at once, for failures that will not go away on a
+    # retry, such as an expired license.
+    if not settings.BITRIX_CIRCUIT_FAILURES:
+        return
+    key, probe_key = _circuit_keys(portal)
+    open_seconds = settings.BITRIX_CIRCUIT_OPEN_SECONDS
+    try:
+        with redis_client.pipeline() as pipe:
+            pipe.delete(probe_key)
+            pipe.hset(key, "open_until", time.time() + open_seconds)
+            pipe.hincrby(key, "failures", 1)
+            pipe.expire(key, open_seconds * 2)
+            pipe.execute()
+    except redis.exceptions.RedisError as exc:
+        logger.warning(f"Bitrix circuit breaker unavailable: {exc}")
+
+
+def record_response(portal, response, tracked):
+    # Server errors count as failures, except rate limit responses, which are
+    # left to the rate limiter. Any other response shows the portal is up.
+    if response.status_code >= 500 and not is_limit_response(response):
+        record_failure(portal)
+    elif tracked:
+        reset(portal)
+
+
+def reset(portal):
+    try:
+        redis_client.delete(*_circuit_keys(portal))
+    except redis.exceptions.RedisError as exc:
+        logger.warning(f"Bitrix circuit breaker unavailable: {exc}")
@@ -1,16 +1,43 @@
 import logging
+import os
 import re
+import threading
+import time
+import uuid
+import redis
 import requests
-from urllib.parse import urlparse
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlencode, urlparse
 from django.utils import timezone
 
+from django.core.cache import cache
 from django.db import transaction
 from django.conf import settings
 
 from .models import AppInstance, Credential, User
+from . import circuit
+from .ratelimit import BitrixRateLimitError, acquire, is_limit_response, penalize
 
 logger = logging.getLogger("django")
 
+redis_client = redis.StrictRedis.from_url(settings.REDIS_URL)
+
+# One OAuth refresh per credential at a time; the lock expires on its own if
+# its holder dies or its transaction is rolled back.
+REFRESH_LOCK_TIMEOUT = 30
+REFRESH_WAIT_TIMEOUT = 20
+
+# Bitrix runs at most this many commands in one batch call.
+BATCH_MAX_COMMANDS = 50
+# Rows per page of Bitrix list methods
+LIST_PAGE_SIZE = 50
+# Response of a command that did not run because an earlier one failed with halt
+BATCH_NOT_EXECUTED = {
+    "error": "NOT_EXECUTED",
+    "error_description": "Skipped after an earlier error in the batch",
+}
+
 
 class BitrixAccessDeniedError(Exception):
     pass
@@ -33,6 +60,115 @@ def _connection_error_status(exc):
     return -1
 
 
+_sessions = OrderedDict()
+_sessions_lock = threading.Lock()
+_sessions_pid = None
+
+
+def _create_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=settings.BITRIX_HTTP_POOL_MAXSIZE,
+        max_retries=0,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session(url):
+    # One keep-alive session per portal host, shared by the whole process, so
+    # repeated calls to a portal skip the DNS, TCP and TLS handshakes. Only the
+    # most recently used BITRIX_HTTP_MAX_HOSTS hosts keep their connections.
+    global _sessions_pid
+
+    parsed = urlparse(url)
+    host = f"{parsed.scheme}://{parsed.netloc}"
+    with _sessions_lock:
+        if _sessions_pid != os.getpid():
+            # Never share sockets with the parent of a forked Celery worker.
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+
+        session = _sessions.get(host)
+        if session is not None:
+            _sessions.move_to_end(host)
+            return session
+
+        session = _sessions[host] = _create_session()
+        while len(_sessions) > settings.BITRIX_HTTP_MAX_HOSTS:
+            _, evicted = _sessions.popitem(last=False)
+            evicted.close()
+        return session
+
+
+# (app instance id, admin) -> (portal id, generation, expires at, [(user, credential)])
+_credentials = {}
+_credentials_lock = threading.Lock()
+
+
+def _credentials_generation_key(portal_id):
+    return f"bitrix:credentials:{portal_id}"
+
+
+def invalidate_credentials(portal_id):
+    # Drops the cached credentials of the portal in this process and, through
+    # the generation stamp in the shared cache, in every other process. Done
+    # once the current transaction commits, so no process can cache the old
+    # rows again under the new stamp; right away outside a transaction.
+    if not portal_id:
+        return
+
+    def invalidate():
+        with _credentials_lock:
+            for key in [key for key, entry in _credentials.items() if entry[0] == portal_id]:
+                del _credentials[key]
+        cache.set(_credentials_generation_key(portal_id), uuid.uuid4().hex, 60 * 60 * 24)
+
+    transaction.on_commit(invalidate)
+
+
+def _load_credentials(appinstance, admin):
+    credentials = (
+        Credential.objects.filter(
+            app_instance=appinstance,
+            user__bitrix_id=appinstance.portal_id,
+            user__admin=admin,
+            user__active=True,
+        )
+        .select_related("user")
+        .order_by("user_id", "id")
+    )
+    pairs = []
+    seen = set()
+    for credential in credentials:
+        # First credential of each user, as credentials.filter(...).first()
+        if credential.user_id not in seen:
+            seen.add(credential.user_id)
+            pairs.append((credential.user, credential))
+    return pairs
+
+
+def _portal_credentials(appinstance, admin):
+    # The users call_method tries for the instance and their credentials, with
+    # the tokens already decrypted, cached for BITRIX_CREDENTIAL_CACHE_TTL.
+    ttl = settings.BITRIX_CREDENTIAL_CACHE_TTL
+    if not ttl:
+        return _load_credentials(appinstance, admin)
+
+    key = (appinstance.id, admin)
+    generation = cache.get(_credentials_generation_key(appinstance.portal_id))
+    entry = _credentials.get(key)
+    if entry and entry[1] == generation and entry[2] > time.monotonic():
+        return entry[3]
+
+    pairs = _load_credentials(appinstance, admin)
+    with _credentials_lock:
+        _credentials[key] = (appinstance.portal_id, generation, time.monotonic() + ttl, pairs)
+    return pairs
+
+
 def _response_json(response, b24_method):
     try:
         return response.json()
@@ -43,6 +179,106 @@ def _response_json(response, b24_method):
         ) from exc
 
 
+def _call_credentials(appinstance, admin, b24_user_id):
+    if b24_user_id:
+        b24_user = User.objects.get(id=b24_user_id)
+        return [(b24_user, b24_user.credentials.filter(app_instance=appinstance).first())]
+    return _portal_credentials(appinstance, admin)
+
+
+def _handle_response(appinstance, b24_method, b24_user, credential, response,
+                     attempt, attempted_refresh):
+    # What call_method does with a portal response. Returns ("result", json),
+    # ("retry", None) to send the request again, ("redirect", None) to call
+    # the moved portal, or ("failed", exc) to go on with the next user;
+    # raises when no user can succeed.
+    portal = appinstance.portal
+    if response.status_code == 302 and not attempted_refresh:
+        new_url = response.headers['Location']
+        parsed_url = urlparse(new_url)
+        domain = parsed_url.netloc
+        if portal.domain != domain:
+            portal.domain = domain
+            try:
+                portal.save()
+            except Exception:
+                pass
+        return "redirect", None
+
+    elif is_limit_response(response):
+        # The portal throttles the app, not the user: feed it back into
+        # the shared bucket and retry once it has refilled.
+        penalize(portal)
+        if attempt["limit_retries"] >= settings.BITRIX_RATE_LIMIT_RETRIES:
+            raise BitrixRateLimitError(
+                f"QUERY_LIMIT_EXCEEDED for portal {portal.domain} method {b24_method}",
+                retry_after=settings.BITRIX_RATE_PENALTY,
+            )
+        attempt["limit_retries"] += 1
+        return "retry", None
+
+    elif response.status_code == 200:
+        if portal.license_expired:
+            portal.license_expired = False
+            try:
+                portal.save()
+            except Exception:
+                pass
+        return "result", _response_json(response, b24_method)
+
+    elif response.status_code == 401:
+        resp = _response_json(response, b24_method)
+        error = resp.get("error", "")
+        if error == "ACCESS_DENIED":
+            if not portal.license_expired:
+                portal.license_expired = True
+                try:
+                    portal.save()
+                except Exception:
+                    pass
+            circuit.trip(portal)
+            raise BitrixAccessDeniedError(response.text)
+        elif error == "expired_token" and not attempt["refresh_attempted"]:
+            refreshed = refresh_token(credential)
+            if refreshed:
+                attempt["refresh_attempted"] = True
+                return "retry", None
+            else:
+                return "failed", Exception(f"Token refresh failed for user {b24_user.user_id} in portal {portal.domain}")
+        elif error == "authorization_error":
+            b24_user.active = False
+            try:
+                b24_user.save()
+            except Exception:
+                pass
+
+        return "failed", Exception(f"Unauthorized error: instance {appinstance.id} {resp}")
+    elif response.status_code == 403:
+        try:
+            resp_data = _response_json(response, b24_method)
+            if resp_data.get("error") == "ACCESS_DENIED":
+                if not portal.license_expired:
+                    portal.license_expired = True
+                    try:
+                        portal.save()
+                    except Exception:
+                        pass
+                circuit.trip(portal)
+                raise BitrixAccessDeniedError(response.text)
+            return "failed", Exception(f"Access error: instance {appinstance.id} {resp_data}")
+        except ValueError:
+            portal.license_expired = True
+            try:
+                portal.save()
+            except Exception:
+                pass
+            circuit.trip(portal)
+            raise BitrixAccessDeniedError(response.text)
+    else:
+        return "failed", Exception(f"Failed to call bitrix: {appinstance.portal.domain} "
+                                   f"status {response.status_code}, response: {response.text}")
+
+
 def call_method(appinstance: AppInstance, 
                 b24_method: str, 
                 data: dict=None, 
@@ -55,32 +291,39 @@ def call_method(appinstance: AppInstance,
         data = {}
     
     portal = appinstance.portal
-    if b24_user_id:
-        b24_user = User.objects.get(id=b24_user_id)
-        b24_users = [b24_user]
-    else:
-        b24_users = portal.users.filter(admin=admin, active=True)
+    b24_credentials = _call_credentials(appinstance, admin, b24_user_id)
 
     last_exc = None
-    for b24_user in b24_users:
-        credential = b24_user.credentials.filter(app_instance=appinstance).first()
+    for b24_user, credential in b24_credentials:
         if not credential:
             continue
         
-        refresh_attempted = False
+        attempt = {"refresh_attempted": False, "limit_retries": 0}
         while True:
             endpoint = f"{portal.protocol}://{portal.domain}/rest"
             payload = {"auth": credential.access_token, **data}
+            circuit_tracked = circuit.allow(portal)
+            try:
+                acquire(portal)
+            except BitrixRateLimitError:
+                circuit.release(portal, circuit_tracked)
+                raise
             try:
-                response = requests.post(f"{endpoint}/{b24_method}", json=payload,
-                                        allow_redirects=False, verify=verify, timeout=timeout)
+                url = f"{endpoint}/{b24_method}"
+                response = get_session(url).post(url, json=payload,
+                                                 allow_redirects=False, verify=verify, timeout=timeout)
                 _save_instance_status(appinstance, response.status_code)
+                circuit.record_response(portal, response, circuit_tracked)
             except requests.exceptions.Timeout:
                 # If timeout occurs, we should probably stop trying for this user/portal this time
                 # and let the caller handle the retry (e.g. Celery task)
+                circuit.record_failure(portal)
                 raise
             except requests.exceptions.SSLError:
                 if verify:
+                    if circuit_tracked:
+                        # The portal answered, only its certificate is invalid.
+                        circuit.reset(portal)
                     return call_method(
                         appinstance,
                         b24_method,
@@ -95,18 +338,14 @@ def call_method(appinstance: AppInstance,
                     raise
             except requests.exceptions.ConnectionError as exc:
                 _save_instance_status(appinstance, _connection_error_status(exc))
+                circuit.record_failure(portal)
                 raise
 
-            if response.status_code == 302 and not attempted_refresh:
-                new_url = response.headers['Location']
-                parsed_url = urlparse(new_url)
-                domain = parsed_url.netloc
-                if portal.domain != domain:
-                    portal.domain = domain
-                    try:
-                        portal.save()
-                    except Exception:
-                        pass
+            outcome, value = _handle_response(
+                appinstance, b24_method, b24_user, credential, response,
+                attempt, attempted_refresh,
+            )
+            if outcome == "redirect":
                 return call_method(
                     appinstance,
                     b24_method,
@@ -117,75 +356,205 @@ def call_method(appinstance: AppInstance,
                     b24_user_id=b24_user_id,
                     timeout=timeout,
                 )
-
-            elif response.status_code == 200:
-                if portal.license_expired:
-                    portal.license_expired = False
-                    try:
-                        portal.save()
-                    except Exception:
-                        pass
-                return _response_json(response, b24_method)
-
-            elif response.status_code == 401:
-                resp = _response_json(response, b24_method)
-                error = resp.get("error", "")
-                if error == "ACCESS_DENIED":
-                    if not portal.license_expired:
-                        portal.license_expired = True
-                        try:
-                            portal.save()
-                        except Exception:
-                            pass
-                    raise BitrixAccessDeniedError(response.text)
-                elif error == "expired_token" and not refresh_attempted:
-                    refreshed = refresh_token(credential)
-                    if refreshed:
-                        refresh_attempted = True
-                        continue
-                    else:
-                        last_exc = Exception(f"Token refresh failed for user {b24_user.user_id} in portal {portal.domain}")
-                        break
-                elif error == "authorization_error":
-                    b24_user.active = False
-                    try:
-                        b24_user.save()
-                    except Exception:
-                        pass
-                
-                last_exc = Exception(f"Unauthorized error: instance {appinstance.id} {resp}")
-                break
-            elif response.status_code == 403:
-                try:
-                    resp_data = _response_json(response, b24_method)
-                    if resp_data.get("error") == "ACCESS_DENIED":
-                        if not portal.license_expired:
-                            portal.license_expired = True
-                            try:
-                                portal.save()
-                            except Exception:
-                                pass
-                        raise BitrixAccessDeniedError(response.text)
-                    last_exc = Exception(f"Access error: instance {appinstance.id} {resp_data}")
-                    break
-                except ValueError:
-                    portal.license_expired = True
-                    try:
-                        portal.save()
-                    except Exception:
-                        pass
-                    raise BitrixAccessDeniedError(response.text)
-            else:
-                last_exc = Exception(f"Failed to call bitrix: {appinstance.portal.domain} "
-                                f"status {response.status_code}, response: {response.text}")
-                break
+            if outcome == "retry":
+                continue
+            if outcome == "result":
+                return value
+            last_exc = value
+            break
             
     if last_exc:
         raise Exception(f"{last_exc} method: {b24_method} data:{data}")
     raise Exception("No active users for portal")
 
 
+def build_query(params):
+    # Encodes params the way PHP http_build_query does, which is how batch
+    # expects the parameters of each command.
+    pairs = []
+
+    def add(key, value):
+        if isinstance(value, dict):
+            for sub_key, sub_value in value.items():
+                add(f"{key}[{sub_key}]", sub_value)
+        elif isinstance(value, (list, tuple)):
+            for index, sub_value in enumerate(value):
+                add(f"{key}[{index}]", sub_value)
+        elif isinstance(value, bool):
+            pairs.append((key, int(value)))
+        elif value is not None:
+            pairs.append((key, value))
+
+    for key, value in params.items():
+        add(str(key), value)
+    return urlencode(pairs)
+
+
+def call_batch(appinstance: AppInstance, commands, halt=False, **kwargs):
+    # Runs [(method, params), ...] through the Bitrix batch method, up to
+    # BATCH_MAX_COMMANDS per request. Returns one response per command, in
+    # order, shaped like the response of a single call: {"result": ...} or
+    # {"error": ..., "error_description": ...}.
+    responses = []
+    for start in range(0, len(commands), BATCH_MAX_COMMANDS):
+        cmd = {}
+        for index, (method, params) in enumerate(commands[start:start + BATCH_MAX_COMMANDS]):
+            query = build_query(params or {})
+            cmd[f"cmd{index}"] = f"{method}?{query}" if query else method
+
+        response = call_method(appinstance, "batch", {"halt": int(halt), "cmd": cmd}, **kwargs)
+        batch = response.get("result") or {}
+        # PHP encodes an empty result as a list
+        results = batch.get("result") or {}
+        errors = batch.get("result_error") or {}
+        totals = batch.get("result_total") or {}
+        next_pages = batch.get("result_next") or {}
+        for name in cmd:
+            if name in errors:
+                responses.append(errors[name])
+            elif name in results:
+                item = {"result": results[name]}
+                if name in totals:
+                    item["total"] = totals[name]
+                if name in next_pages:
+                    item["next"] = next_pages[name]
+                responses.append(item)
+            else:
+                responses.append(dict(BATCH_NOT_EXECUTED))
+
+        if halt and errors:
+            break
+
+    while len(responses) < len(commands):
+        responses.append(dict(BATCH_NOT_EXECUTED))
+    return responses
+
+
+def batch_errors(commands, responses):
+    return [
+        f"{method}: {response.get('error_description') or response.get('error')}"
+        for (method, _), response in zip(commands, responses)
+        if "error" in response
+    ]
+
+
+def _adopt_stored_token(credential):
+    # Returns True when another worker refreshed the credential after it was
+    # loaded, copying the stored tokens onto it.
+    stored = Credential.objects.filter(id=credential.id).values(
+        "access_token", "refresh_token", "refresh_date"
+    ).first()
+    if not stored or stored["refresh_token"] == credential.refresh_token:
+        return False
+    credential.access_token = stored["access_token"]
+    credential.refresh_token = stored["refresh_token"]
+    credential.refresh_date = stored["refresh_date"]
+    return True
+
+
+def _release_lock(lock):
+    try:
+        lock.release()
+    except redis.exceptions.RedisError:
+        pass
+
+
+def _list_rows(result, key=None):
+    if key:
+        return (result or {}).get(key) or []
+    if isinstance(result, dict):
+        # Methods like crm.item.list wrap the rows: {"items": [...]}
+        lists = [value for value in result.values() if isinstance(value, list)]
+        return lists[0] if len(lists) == 1 else list(result.values())
+    return result or []
+
+
+def iter_list(appinstance: AppInstance,
+              b24_method: str,
+              data: dict=None,
+              key=None,
+              fast=False,
+              id_field="ID",
+              prefetch=0,
+              **kwargs):
+    # Yields the rows of a Bitrix list method page by page, so lists of any
+    # length are walked in constant memory. `key` names the field holding the
+    # rows when the result wraps them, e.g. "items" for crm.item.list.
+    #
+    # fast: pages with start=-1 and a filter on `id_field` ordered ascending,
+    # which spares the portal its COUNT query. The method must support
+    # filtering and ordering by that field.
+    # prefetch: after the first page, fetches that many pages per batch call.
+    data = dict(data or {})
+    if fast:
+        last_id = 0
+        while True:
+            page = {
+                **data,
+                "filter": {**data.get("filter", {}), f">{id_field}": last_id},
+                "order": {id_field: "ASC"},
+                "start": -1,
+            }
+            rows = _list_rows(call_method(appinstance, b24_method, page, **kwargs).get("result"), key)
+            yield from rows
+            if len(rows) < LIST_PAGE_SIZE:
+                return
+            last_id = rows[-1][id_field]
+
+    response = call_method(appinstance, b24_method, {**data, "start": data.get("start", 0)}, **kwargs)
+    yield from _list_rows(response.get("result"), key)
+    next_start = response.get("next")
+    total = response.get("total")
+
+    if prefetch and next_start is not None and total is not None:
+        starts = range(next_start, total, LIST_PAGE_SIZE)
+        step = min(prefetch, BATCH_MAX_COMMANDS)
+        for offset in range(0, len(starts), step):
+            commands = [(b24_method, {**data, "start": start}) for start in starts[offset:offset + step]]
+            responses = call_batch(appinstance, commands, **kwargs)
+            errors = batch_errors(commands, responses)
+            if errors:
+                raise Exception(f"Failed to list {b24_method}: {'; '.join(errors)}")
+            for response in responses:
+                yield from _list_rows(response.get("result"), key)
+        return
+
+    while next_start is not None:
+        response = call_method(appinstance, b24_method, {**data, "start": next_start}, **kwargs)
+        yield from _list_rows(response.get("result"), key)
+        next_start = response.get("next")
+
+
 def refresh_token(credential: Credential, raise_request_exception=False):
+    # Single flight: concurrent callers wait for the first one and reuse the
+    # token it stored. Refreshing twice would rotate the refresh token under
+    # the first caller and invalidate its result.
+    lock = redis_client.lock(
+        f"bitrix:refresh:{credential.id}",
+        timeout=REFRESH_LOCK_TIMEOUT,
+        blocking_timeout=REFRESH_WAIT_TIMEOUT,
+    )
+    try:
+        acquired = lock.acquire()
+    except redis.exceptions.RedisError:
+        # Without Redis every caller refreshes on its own.
+        lock = None
+        acquired = False
+    if lock is not None and not acquired:
+        return _adopt_stored_token(credential)
+
+    try:
+        if _adopt_stored_token(credential):
+            return True
+        return _request_token(credential, raise_request_exception)
+    finally:
+        if acquired:
+            # Waiters must only see the lock free once the new token is
+            # committed, which with ATOMIC_REQUESTS is the end of the request.
+            transaction.on_commit(lambda: _release_lock(lock))
+
+
+def _request_token(credential: Credential, raise_request_exception=False):
     payload = {
         "grant_type": "refresh_token",
         "client_id": credential.app_instance.app.client_id,
@@ -193,7 +562,8 @@ def refresh_token(credential: Credential, raise_request_exception=False):
         "refresh_token": credential.refresh_token,
     }
     try:
-        response = requests.post(f"{settings.BITRIX_OAUTH_URL}/oauth/token/", data=payload, timeout=10)
+        url = f"{settings.BITRIX_OAUTH_URL}/oauth/token/"
+        response = get_session(url).post(url, data=payload, timeout=10)
     except requests.exceptions.RequestException:
         if raise_request_exception:
             raise
@@ -202,9 +572,12 @@ def refresh_token(credential: Credential, raise_request_exception=False):
     try:
         response_data = response.json()
     except Exception:
-        return False
+        response_data = None
 
-    if response.status_code != 200:
+    if response_data is None or response.status_code != 200:
+        # Another process may have rotated the refresh token already, so the
+        # next call should read the credential from the database again.
+        invalidate_credentials(credential.app_instance.portal_id)
         return False
 
     credential.access_token = response_data["access_token"]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bitrix', '0044_alter_app_handler'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='credential',
+            name='refresh_date',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
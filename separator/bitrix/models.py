@@ -137,6 +137,12 @@ class AppInstance(models.Model):
     def get_feature_grant(self, code):
         if not code or not self.portal_id:
             return None
+        if "feature_grants" in getattr(self.portal, "_prefetched_objects_cache", {}):
+            # Loaded with the instance by resolve_app_instance
+            for grant in self.portal.feature_grants.all():
+                if grant.feature.code == code:
+                    return grant
+            return None
         return self.portal.feature_grants.filter(feature__code=code).select_related("feature").first()
 
     def has_active_feature(self, code):
@@ -157,7 +163,7 @@ class Credential(models.Model):
                              blank=True, null=True)
     access_token = EncryptedCharField(max_length=2000, blank=True)
     refresh_token = EncryptedCharField(max_length=2000, blank=True)
-    refresh_date = models.DateTimeField(blank=True, null=True)
+    refresh_date = models.DateTimeField(blank=True, null=True, db_index=True)
 
 
 class ImNotify(models.Model):
@@ -0,0 +1,56 @@
+def split_key(key):
+    # "data[MESSAGES][0][im]" -> ["data", "MESSAGES", "0", "im"]; a key that
+    # is not in bracket notation stays whole.
+    if not isinstance(key, str):
+        return [key]
+    start = key.find("[")
+    if start <= 0 or not key.endswith("]"):
+        return [key]
+    path = [key[:start]] + key[start + 1:-1].split("][")
+    if "]" in path[0] or any("[" in segment or "]" in segment for segment in path[1:]):
+        return [key]
+    return path
+
+
+class EventPayload(dict):
+    # A Bitrix event as posted: flat form keys such as
+    # data[MESSAGES][0][message][files][0][name]. Lookups by those keys work
+    # as on the plain dict; `tree` holds the same values nested by bracket
+    # segment, and `leaves` the first value of every last segment, so
+    # processors can walk or search the event without scanning its keys.
+
+    def __init__(self, data=()):
+        super().__init__(data)
+        self.tree = {}
+        self.leaves = {}
+        for key, value in self.items():
+            path = split_key(key)
+            if len(path) > 1:
+                self.leaves.setdefault(path[-1], value)
+            node = self.tree
+            for segment in path[:-1]:
+                child = node.get(segment)
+                if not isinstance(child, dict):
+                    child = node[segment] = {}
+                node = child
+            # An empty segment appends, like name[] in PHP. A value never
+            # replaces a branch: data[FILES] does not hide data[FILES][0][name].
+            segment = path[-1] or str(len(node))
+            if not isinstance(node.get(segment), dict):
+                node[segment] = value
+
+    def get_path(self, *path, default=None):
+        node = self.tree
+        for segment in path:
+            if not isinstance(node, dict) or segment not in node:
+                return default
+            node = node[segment]
+        return node
+
+
+def parse_event(data):
+    # Parses each event once: processors pass the result on to the helpers
+    # they call, which get it back as is.
+    if isinstance(data, EventPayload):
+        return data
+    return EventPayload(data)
@@ -0,0 +1,145 @@
+import logging
+import math
+import time
+
+import redis
+from celery import current_task
+from django.conf import settings
+
+logger = logging.getLogger("django")
+
+redis_client = redis.StrictRedis.from_url(settings.REDIS_URL)
+
+KEY_PREFIX = "bitrix:ratelimit:"
+
+# Token bucket shared by every process calling the portal. A call always
+# takes its token, letting the balance go negative, and gets back how many
+# milliseconds to wait for it, so concurrent callers are spaced out at the
+# refill rate instead of polling. A call that would wait longer than the
+# allowed maximum takes nothing and returns the wait as a negative number.
+ACQUIRE = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local max_wait = tonumber(ARGV[3])
+local clock = redis.call("TIME")
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = math.max(0, (1 - tokens) / rate)
+if wait > max_wait then
+    return -math.ceil(wait * 1000)
+end
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens - 1), "updated", tostring(now))
+redis.call("EXPIRE", KEYS[1], ARGV[4])
+return math.ceil(wait * 1000)
+"""
+
+# Called when the portal answered QUERY_LIMIT_EXCEEDED: its own bucket is
+# full, so the local one is emptied and charged `penalty` seconds of refill.
+PENALIZE = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local clock = redis.call("TIME")
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+tokens = math.min(tokens, 0) - tonumber(ARGV[3]) * rate
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "updated", tostring(now))
+redis.call("EXPIRE", KEYS[1], ARGV[4])
+return 1
+"""
+
+acquire_script = redis_client.register_script(ACQUIRE)
+penalize_script = redis_client.register_script(PENALIZE)
+
+
+class BitrixRateLimitError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _bucket_key(portal):
+    return f"{KEY_PREFIX}{portal.member_id or portal.domain}"
+
+
+def _bucket_ttl():
+    rate = settings.BITRIX_RATE_LIMIT
+    refill = settings.BITRIX_RATE_BURST / rate + settings.BITRIX_RATE_PENALTY
+    return math.ceil(refill) + 60
+
+
+def reserve(portal, max_wait=None):
+    # Takes a slot from the portal's bucket and returns how many seconds to
+    # wait before using it. Raises BitrixRateLimitError when that would take
+    # longer than max_wait (BITRIX_RATE_MAX_WAIT by default), so a Celery
+    # task is retried later instead.
+    if not settings.BITRIX_RATE_LIMIT:
+        return 0
+    if max_wait is None:
+        max_wait = settings.BITRIX_RATE_MAX_WAIT
+    try:
+        wait_ms = acquire_script(
+            keys=[_bucket_key(portal)],
+            args=[
+                settings.BITRIX_RATE_LIMIT,
+                settings.BITRIX_RATE_BURST,
+                max_wait,
+                _bucket_ttl(),
+            ],
+        )
+    except redis.exceptions.RedisError as exc:
+        # The limiter must not take Bitrix calls down with Redis.
+        logger.warning(f"Bitrix rate limiter unavailable: {exc}")
+        return 0
+
+    if wait_ms < 0:
+        raise BitrixRateLimitError(
+            f"Rate limit for portal {portal.domain}: next slot in {-wait_ms} ms",
+            retry_after=-wait_ms / 1000,
+        )
+    return wait_ms / 1000
+
+
+def acquire(portal):
+    # Blocks until the portal has capacity for one more request. Outside a
+    # Celery task, e.g. in a view calling crest inline, the wait is capped at
+    # BITRIX_RATE_REQUEST_MAX_WAIT so a request thread is not held for long.
+    if current_task:
+        wait = reserve(portal)
+    else:
+        wait = reserve(portal, settings.BITRIX_RATE_REQUEST_MAX_WAIT)
+    if wait:
+        time.sleep(wait)
+
+
+def penalize(portal):
+    if not settings.BITRIX_RATE_LIMIT:
+        return
+    try:
+        penalize_script(
+            keys=[_bucket_key(portal)],
+            args=[
+                settings.BITRIX_RATE_LIMIT,
+                settings.BITRIX_RATE_BURST,
+                settings.BITRIX_RATE_PENALTY,
+                _bucket_ttl(),
+            ],
+        )
+    except redis.exceptions.RedisError as exc:
+        logger.warning(f"Bitrix rate limiter unavailable: {exc}")
+
+
+def is_limit_response(response):
+    if response.status_code == 429:
+        return True
+    if response.status_code != 503:
+        return False
+    try:
+        return response.json().get("error") == "QUERY_LIMIT_EXCEEDED"
+    except (ValueError, AttributeError):
+        return False
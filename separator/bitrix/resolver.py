@@ -0,0 +1,97 @@
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Prefetch
+
+from .models import AppInstance, FeatureGrant
+
+# Bumped when something every instance shows changes, such as an app.
+GLOBAL_GENERATION_KEY = "bitrix:appinstances"
+
+# application token -> (portal id, generations, expires at, app instance)
+_instances = {}
+_instances_lock = threading.Lock()
+
+
+def _generation_key(portal_id):
+    return f"{GLOBAL_GENERATION_KEY}:{portal_id}"
+
+
+def _generations(portal_id):
+    keys = [GLOBAL_GENERATION_KEY, _generation_key(portal_id)]
+    values = cache.get_many(keys)
+    return tuple(values.get(key) for key in keys)
+
+
+def invalidate_app_instances(portal_id=None):
+    # Drops the cached instances of the portal, or of every portal, in this
+    # process and, through the generation stamps in the shared cache, in
+    # every other process, once the current transaction commits.
+    def invalidate():
+        with _instances_lock:
+            if portal_id is None:
+                _instances.clear()
+            else:
+                for key in [key for key, entry in _instances.items() if entry[0] == portal_id]:
+                    del _instances[key]
+        key = _generation_key(portal_id) if portal_id else GLOBAL_GENERATION_KEY
+        cache.set(key, uuid.uuid4().hex, 60 * 60 * 24)
+
+    transaction.on_commit(invalidate)
+
+
+def _load_app_instance(application_token):
+    return (
+        AppInstance.objects.filter(application_token=application_token)
+        .select_related("app", "app__site", "portal")
+        .prefetch_related(
+            "app__connectors",
+            Prefetch(
+                "portal__feature_grants",
+                queryset=FeatureGrant.objects.select_related("feature"),
+            ),
+        )
+        .first()
+    )
+
+
+def resolve_app_instance(application_token):
+    # The app instance an inbound event is for, with its app, site, portal,
+    # connectors and feature grants loaded, cached for
+    # BITRIX_APPINSTANCE_CACHE_TTL. Returns None for an unknown token, which
+    # is not cached: the instance may be being installed.
+    ttl = settings.BITRIX_APPINSTANCE_CACHE_TTL
+    if not ttl or not application_token:
+        return _load_app_instance(application_token)
+
+    entry = _instances.get(application_token)
+    if entry:
+        portal_id = entry[0]
+    else:
+        row = AppInstance.objects.filter(application_token=application_token).values_list(
+            "portal_id"
+        ).first()
+        if row is None:
+            return None
+        portal_id = row[0]
+    # Read before the instance is loaded: an invalidation committed while it
+    # loads then leaves it cached under the old stamps, which no longer match.
+    generations = _generations(portal_id)
+    if entry and entry[2] > time.monotonic() and entry[1] == generations:
+        return entry[3]
+
+    appinstance = _load_app_instance(application_token)
+    if appinstance is None or appinstance.portal_id != portal_id:
+        return appinstance
+    with _instances_lock:
+        _instances[application_token] = (
+            appinstance.portal_id,
+            generations,
+            time.monotonic() + ttl,
+            appinstance,
+        )
+    return appinstance
@@ -1,4 +1,5 @@
 import requests
+from celery import Task
 from kombu.exceptions import OperationalError as KombuOperationalError
 from django.conf import settings
 from django.db import InterfaceError, OperationalError, DatabaseError
@@ -6,6 +7,9 @@ from redis.exceptions import ConnectionError as RedisConnectionError
 from redis.exceptions import ReadOnlyError as RedisReadOnlyError
 from redis.exceptions import TimeoutError as RedisTimeoutError
 
+from .circuit import BitrixCircuitOpenError
+from .ratelimit import BitrixRateLimitError
+
 _asterx_errors: tuple = ()
 if getattr(settings, "ASTERX_SERVER", False):
     from separator.asterx.utils import SendCallInfoError
@@ -20,10 +24,30 @@ TRANSIENT_ERRORS = (
     RedisTimeoutError,
     RedisReadOnlyError,
     KombuOperationalError,
+    BitrixRateLimitError,
+    BitrixCircuitOpenError,
     *_asterx_errors,
 )
 
+
+class RetryAfterTask(Task):
+    # Rate limit and open circuit errors say when the portal can be called
+    # again; a retry is not scheduled before then, whatever the backoff. Also
+    # the base of WABA tasks, which call Bitrix too.
+
+    def retry(self, args=None, kwargs=None, exc=None, throw=True,
+              eta=None, countdown=None, max_retries=None, **options):
+        retry_after = getattr(exc, "retry_after", None)
+        if retry_after and eta is None:
+            countdown = max(countdown or 0, retry_after)
+        return super().retry(
+            args=args, kwargs=kwargs, exc=exc, throw=throw, eta=eta,
+            countdown=countdown, max_retries=max_retries, **options,
+        )
+
+
 RETRY_KWARGS = {
+    "base": RetryAfterTask,
     "autoretry_for": TRANSIENT_ERRORS,
     "retry_backoff": 5,
     "retry_backoff_max": 600,
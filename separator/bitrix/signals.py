@@ -1 +1,60 @@
-"""Bitrix signal hooks are intentionally empty."""
+from django.contrib.sites.models import Site
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .crest import invalidate_credentials
+from .models import App, AppInstance, Bitrix, Connector, Credential, Feature, FeatureGrant, User
+from .resolver import invalidate_app_instances
+
+
+@receiver(post_save, sender=Credential)
+@receiver(post_delete, sender=Credential)
+def reset_credential_cache(sender, instance, raw=False, **kwargs):
+    if raw or not instance.app_instance_id:
+        return
+    portal_id = AppInstance.objects.filter(id=instance.app_instance_id).values_list(
+        "portal_id",
+        flat=True,
+    ).first()
+    invalidate_credentials(portal_id)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def reset_user_credential_cache(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    invalidate_credentials(instance.bitrix_id)
+
+
+@receiver(post_save, sender=AppInstance)
+@receiver(post_delete, sender=AppInstance)
+@receiver(post_save, sender=FeatureGrant)
+@receiver(post_delete, sender=FeatureGrant)
+def reset_portal_app_instances(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    invalidate_app_instances(instance.portal_id)
+
+
+@receiver(post_save, sender=Bitrix)
+@receiver(post_delete, sender=Bitrix)
+def reset_portal_cache(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    invalidate_app_instances(instance.pk)
+
+
+@receiver(post_save, sender=App)
+@receiver(post_delete, sender=App)
+@receiver(post_save, sender=Connector)
+@receiver(post_delete, sender=Connector)
+@receiver(post_save, sender=Feature)
+@receiver(post_delete, sender=Feature)
+@receiver(post_save, sender=Site)
+@receiver(post_delete, sender=Site)
+@receiver(m2m_changed, sender=App.connectors.through)
+def reset_app_instances(sender, raw=False, **kwargs):
+    if raw:
+        return
+    invalidate_app_instances()
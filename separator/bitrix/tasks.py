@@ -1,5 +1,6 @@
 import re
 import os
+import math
 import redis
 import logging
 import requests
@@ -7,12 +8,13 @@ from copy import deepcopy
 from celery import shared_task
 from celery.exceptions import Retry
 from django.conf import settings
+from django.db.models import F, Q
 from django.utils import timezone
 from datetime import timedelta
 
-from .crest import BitrixAccessDeniedError, call_method, refresh_token
+from .crest import BitrixAccessDeniedError, batch_errors, call_batch, call_method, iter_list, refresh_token
 from .models import ApiCall, AppInstance, Credential, Feature, FeatureGrant
-from .retry import RETRY_KWARGS, TRANSIENT_ERRORS
+from .retry import RETRY_KWARGS, TRANSIENT_ERRORS, RetryAfterTask
 
 from separator.waba.models import Phone
 from separator.waweb.models import Session
@@ -91,6 +93,18 @@ def call_api(id, method, payload, b24_user=None):
     return call_method(app_instance, method, payload, b24_user_id=b24_user, timeout=10)
 
 
+@shared_task(queue='bitrix', **RETRY_KWARGS)
+def call_batch_api(id, commands, b24_user=None):
+    # Same as call_api for a list of [method, payload] commands, sent through
+    # the Bitrix batch method. Fails if any of the commands failed.
+    app_instance = AppInstance.objects.get(id=id)
+    responses = call_batch(app_instance, commands, b24_user_id=b24_user, timeout=30)
+    errors = batch_errors(commands, responses)
+    if errors:
+        raise Exception(f"Batch commands failed for instance {app_instance.id}: {'; '.join(errors)}")
+    return responses
+
+
 @shared_task(queue="bitrix", **RETRY_KWARGS)
 def dispatch_api_call(api_call_id):
     api_call = ApiCall.objects.select_related("app").get(id=api_call_id)
@@ -133,9 +147,14 @@ def register_feature(app_instance_id, feature_id, placement_code=None, force=Fal
         )
 
     payloads = _build_feature_payloads(feature, placement_code=placement_code)
-    responses = []
-    for payload in payloads:
-        responses.append(call_method(app_instance, feature.method, payload, timeout=30))
+    if len(payloads) == 1:
+        responses = [call_method(app_instance, feature.method, payloads[0], timeout=30)]
+    else:
+        commands = [(feature.method, payload) for payload in payloads]
+        responses = call_batch(app_instance, commands, timeout=30)
+        errors = batch_errors(commands, responses)
+        if errors:
+            raise Exception(f"Feature {feature.id} registration failed: {'; '.join(errors)}")
 
     code = str(feature.code or "").strip() or None
     if code:
@@ -180,16 +199,52 @@ def apply_feature_now(feature_id):
         "queued": queued,
     }
 
+def _stale_credentials(period):
+    cutoff = timezone.now() - timedelta(days=period)
+    return Credential.objects.filter(Q(refresh_date__isnull=True) | Q(refresh_date__lt=cutoff))
+
+
 @shared_task(queue='bitrix', **RETRY_KWARGS)
 def upd_refresh_token(period):
-    now = timezone.now()
-    credentials = Credential.objects.all()
+    # Only ids of credentials due for a refresh are read, in index order and
+    # without decrypting tokens. They are refreshed in chunks of
+    # BITRIX_TOKEN_REFRESH_BATCH by one task each, the chunks spread evenly
+    # over BITRIX_TOKEN_REFRESH_WINDOW seconds instead of starting at once.
+    credentials = _stale_credentials(period)
+    batch_size = max(1, settings.BITRIX_TOKEN_REFRESH_BATCH)
+    chunks = math.ceil(credentials.count() / batch_size)
+    if not chunks:
+        return 0
+    spacing = max(0, settings.BITRIX_TOKEN_REFRESH_WINDOW) / chunks
+
+    credential_ids = credentials.order_by(F("refresh_date").asc(nulls_first=True)).values_list(
+        "id", flat=True
+    )
+    chunk = []
+    queued = 0
+    for credential_id in credential_ids.iterator(chunk_size=batch_size):
+        chunk.append(credential_id)
+        if len(chunk) == batch_size:
+            upd_cred_tokens.apply_async((chunk, period), countdown=queued * spacing)
+            queued += 1
+            chunk = []
+    if chunk:
+        upd_cred_tokens.apply_async((chunk, period), countdown=queued * spacing)
+        queued += 1
+    return queued
+
+
+@shared_task(queue='bitrix', **RETRY_KWARGS)
+def upd_cred_tokens(credential_ids, period):
+    # Credentials refreshed since the chunk was queued are skipped. A failed
+    # refresh is retried on its own so it does not hold up the chunk.
+    credentials = _stale_credentials(period).filter(id__in=credential_ids).select_related(
+        "app_instance__app"
+    )
     for credential in credentials:
-        need_refresh = (
-            credential.refresh_date is None or
-            credential.refresh_date < now - timedelta(days=period)
-        )
-        if need_refresh:
+        try:
+            refresh_token(credential, raise_request_exception=True)
+        except TRANSIENT_ERRORS:
             upd_cred_token.delay(credential.id)
 
 
@@ -306,17 +361,21 @@ def save_ctwa(instace_id, ctwa_id, chat_id, source_id=None):
         if not fields:
             return
 
+        commands = []
         if lead_id and str(lead_id) != "0":
-            call_api.delay(app_instance.id, "crm.lead.update", {
+            commands.append(("crm.lead.update", {
                 "id": lead_id,
                 "fields": fields
-            })
+            }))
             
         if deal_id and str(deal_id) != "0":
-            call_api.delay(app_instance.id, "crm.deal.update", {
+            commands.append(("crm.deal.update", {
                 "id": deal_id,
                 "fields": fields
-            })
+            }))
+
+        if commands:
+            call_batch_api.delay(app_instance.id, commands)
         
     except TRANSIENT_ERRORS:
         raise
@@ -325,7 +384,7 @@ def save_ctwa(instace_id, ctwa_id, chat_id, source_id=None):
         pass
 
 
-@shared_task(bind=True, max_retries=5, default_retry_delay=5, queue='bitrix')
+@shared_task(bind=True, base=RetryAfterTask, max_retries=5, default_retry_delay=5, queue='bitrix')
 def send_messages(self, app_instance_id, user_phone, text, connector,
                   line, pushName=None,
                   message_id=None, attachments=None, profilepic_url=None,
@@ -428,11 +487,8 @@ def prepare_lead(user_id, lead_title):
         },
         "entityTypeId": 3, #contacts
     }
-    client_data = call_method(vendor_instance, "crm.item.list", payload)
-    contact_ids = []
-    if "result" in client_data:
-        client_data = client_data.get("result", {}).get("items", [])
-        contact_ids = [contact.get("id") for contact in client_data if contact.get("id")]
+    contacts = iter_list(vendor_instance, "crm.item.list", payload, key="items")
+    contact_ids = [contact.get("id") for contact in contacts if contact.get("id")]
 
     lead_data = {
         "fields": {
@@ -1 +0,0 @@
-# Create your tests here.
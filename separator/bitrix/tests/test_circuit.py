@@ -0,0 +1,122 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+from separator.bitrix import circuit  # noqa: E402
+
+portal = SimpleNamespace(member_id="member", domain="portal.bitrix24.com")
+
+
+@pytest.fixture(autouse=True)
+def redis_client(monkeypatch, settings):
+    settings.BITRIX_CIRCUIT_FAILURES = 3
+    settings.BITRIX_CIRCUIT_OPEN_SECONDS = 60
+    client = fakeredis.FakeStrictRedis()
+    client.flushall()
+    monkeypatch.setattr(circuit, "redis_client", client)
+    monkeypatch.setattr(
+        circuit,
+        "record_failure_script",
+        client.register_script(circuit.RECORD_FAILURE),
+    )
+    return client
+
+
+def response(status_code, error=None):
+    return SimpleNamespace(status_code=status_code, json=lambda: {"error": error})
+
+
+def open_circuit():
+    for _ in range(3):
+        circuit.record_failure(portal)
+
+
+def half_open(redis_client):
+    # Moves the open window into the past instead of waiting it out.
+    key, _ = circuit._circuit_keys(portal)
+    redis_client.hset(key, "open_until", time.time() - 1)
+
+
+def test_trips_at_the_threshold():
+    assert circuit.allow(portal) is False
+    circuit.record_failure(portal)
+    circuit.record_failure(portal)
+    assert circuit.allow(portal) is True
+
+    circuit.record_failure(portal)
+    with pytest.raises(circuit.BitrixCircuitOpenError) as exc_info:
+        circuit.allow(portal)
+    assert exc_info.value.retry_after == pytest.approx(60, abs=1)
+
+
+def test_admits_a_single_probe(redis_client):
+    open_circuit()
+    half_open(redis_client)
+
+    assert circuit.allow(portal) == circuit.PROBE
+    with pytest.raises(circuit.BitrixCircuitOpenError):
+        circuit.allow(portal)
+
+
+def test_successful_probe_closes_the_circuit(redis_client):
+    open_circuit()
+    half_open(redis_client)
+    tracked = circuit.allow(portal)
+
+    circuit.record_response(portal, response(200), tracked)
+
+    assert circuit.allow(portal) is False
+
+
+def test_failed_probe_reopens_the_circuit(redis_client):
+    open_circuit()
+    half_open(redis_client)
+    tracked = circuit.allow(portal)
+
+    circuit.record_response(portal, response(502), tracked)
+
+    with pytest.raises(circuit.BitrixCircuitOpenError):
+        circuit.allow(portal)
+
+
+def test_rate_limited_probe_is_released(redis_client):
+    open_circuit()
+    half_open(redis_client)
+    tracked = circuit.allow(portal)
+
+    # The limiter refused the probe before it called the portal.
+    circuit.release(portal, tracked)
+
+    assert circuit.allow(portal) == circuit.PROBE
+
+
+def test_limit_response_to_the_probe_frees_it(redis_client):
+    open_circuit()
+    half_open(redis_client)
+    tracked = circuit.allow(portal)
+
+    circuit.record_response(portal, response(429), tracked)
+
+    assert circuit.allow(portal) is False
+
+
+def test_release_leaves_another_callers_probe(redis_client):
+    open_circuit()
+    half_open(redis_client)
+    assert circuit.allow(portal) == circuit.PROBE
+
+    circuit.release(portal, True)
+
+    with pytest.raises(circuit.BitrixCircuitOpenError):
+        circuit.allow(portal)
+
+
+def test_trip_opens_at_once():
+    circuit.trip(portal)
+
+    with pytest.raises(circuit.BitrixCircuitOpenError):
+        circuit.allow(portal)
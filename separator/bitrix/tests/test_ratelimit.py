@@ -0,0 +1,75 @@
+from types import SimpleNamespace
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+from separator.bitrix import ratelimit  # noqa: E402
+
+portal = SimpleNamespace(member_id="member", domain="portal.bitrix24.com")
+
+
+@pytest.fixture(autouse=True)
+def redis_client(monkeypatch, settings):
+    settings.BITRIX_RATE_LIMIT = 10.0
+    settings.BITRIX_RATE_BURST = 2
+    settings.BITRIX_RATE_MAX_WAIT = 5.0
+    settings.BITRIX_RATE_PENALTY = 2.0
+    client = fakeredis.FakeStrictRedis()
+    client.flushall()
+    monkeypatch.setattr(ratelimit, "redis_client", client)
+    monkeypatch.setattr(ratelimit, "acquire_script", client.register_script(ratelimit.ACQUIRE))
+    monkeypatch.setattr(ratelimit, "penalize_script", client.register_script(ratelimit.PENALIZE))
+    return client
+
+
+def test_burst_then_spaced_at_the_refill_rate():
+    assert ratelimit.reserve(portal) == 0
+    assert ratelimit.reserve(portal) == 0
+    assert ratelimit.reserve(portal) == pytest.approx(0.1, abs=0.02)
+    assert ratelimit.reserve(portal) == pytest.approx(0.2, abs=0.02)
+
+
+def test_bucket_refills(redis_client):
+    ratelimit.reserve(portal)
+    ratelimit.reserve(portal)
+    key = ratelimit._bucket_key(portal)
+    # Rewind the last update by a second: ten tokens of refill, capped at the burst.
+    updated = float(redis_client.hget(key, "updated"))
+    redis_client.hset(key, "updated", str(updated - 1))
+
+    assert ratelimit.reserve(portal) == 0
+    assert ratelimit.reserve(portal) == 0
+    assert ratelimit.reserve(portal) > 0
+
+
+def test_penalize_pushes_out_the_next_slot():
+    ratelimit.penalize(portal)
+
+    assert ratelimit.reserve(portal) == pytest.approx(2.1, abs=0.02)
+
+
+def test_wait_over_the_maximum_raises_without_taking_a_slot(settings):
+    settings.BITRIX_RATE_PENALTY = 10.0
+    ratelimit.penalize(portal)
+
+    with pytest.raises(ratelimit.BitrixRateLimitError) as exc_info:
+        ratelimit.reserve(portal)
+    assert exc_info.value.retry_after == pytest.approx(10.1, abs=0.02)
+    assert ratelimit.reserve(portal, max_wait=20) == pytest.approx(10.1, abs=0.02)
+
+
+def test_acquire_outside_a_task_uses_the_request_cap(settings):
+    settings.BITRIX_RATE_REQUEST_MAX_WAIT = 1.0
+    ratelimit.penalize(portal)
+
+    with pytest.raises(ratelimit.BitrixRateLimitError):
+        ratelimit.acquire(portal)
+
+
+def test_disabled_limiter_never_waits(settings):
+    settings.BITRIX_RATE_LIMIT = 0
+    ratelimit.penalize(portal)
+
+    assert ratelimit.reserve(portal) == 0
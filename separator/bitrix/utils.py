@@ -29,6 +29,8 @@ import separator.waweb.tasks as waweb_tasks
 
 from .models import App, AppInstance, Bitrix, Line, VerificationCode, Connector, Credential, Events
 from .models import User as B24_user
+from .payload import parse_event
+from .resolver import resolve_app_instance
 from .retry import RETRY_KWARGS, TRANSIENT_ERRORS
 
 import separator.bitrix.tasks as bitrix_tasks
@@ -466,6 +468,7 @@ def events_bind(appinstance: AppInstance):
     if handlers is None:
         handlers = existing if isinstance(existing, list) else []
 
+    commands = []
     for event in appinstance.app.events.strip().splitlines():
         event = event.strip()
         if not event:
@@ -475,21 +478,20 @@ def events_bind(appinstance: AppInstance):
         has_current = any(h.get("handler") == handler_url for h in matched_handlers)
         for h in matched_handlers:
             if h.get("handler") and h.get("handler") != handler_url:
-                bitrix_tasks.call_api.delay(
-                    appinstance.id,
-                    "event.unbind",
-                    {"event": event, "HANDLER": h.get("handler")},
-                )
+                commands.append(("event.unbind", {"event": event, "HANDLER": h.get("handler")}))
 
         if not has_current:
             payload = {
                 "event": event,
                 "HANDLER": handler_url,
             }
-            bitrix_tasks.call_api.delay(appinstance.id, "event.bind", payload)
+            commands.append(("event.bind", payload))
+
+    if commands:
+        bitrix_tasks.call_batch_api.delay(appinstance.id, commands)
 
 
-def register_connector(appinstance: AppInstance, connector):
+def connector_register_payload(appinstance: AppInstance, connector):
     url = appinstance.app.site
 
     if not connector.icon:
@@ -501,7 +503,7 @@ def register_connector(appinstance: AppInstance, connector):
             encoded_image = base64.b64encode(image_data).decode("utf-8")
             connector_logo = f"data:image/svg+xml;base64,{encoded_image}"
 
-        payload = {
+        return {
             "ID": connector.code,
             "NAME": connector.name,
             "ICON": {
@@ -510,14 +512,23 @@ def register_connector(appinstance: AppInstance, connector):
             "PLACEMENT_HANDLER": f"https://{url}/placement/?inst={appinstance.id}",
         }
 
-        bitrix_tasks.call_api.delay(appinstance.id, "imconnector.register", payload)
-
     except FileNotFoundError:
         return None
     except Exception as e:
         return None
 
 
+def register_connectors(appinstance: AppInstance, connectors):
+    commands = []
+    for connector in connectors:
+        payload = connector_register_payload(appinstance, connector)
+        if payload:
+            commands.append(("imconnector.register", payload))
+
+    if commands:
+        bitrix_tasks.call_batch_api.delay(appinstance.id, commands)
+
+
 def queue_app_features(appinstance: AppInstance):
     app = appinstance.app
     if not app:
@@ -534,30 +545,24 @@ def queue_app_features(appinstance: AppInstance):
 
 def extract_files(data):
     files = []
+    items = parse_event(data).get_path("data", "MESSAGES", "0", "message", "files", default={})
+    if not isinstance(items, dict):
+        return files
     i = 0
     while True:
-        # Формируем ключи для доступа к данным файлов
-        name_key = f"data[MESSAGES][0][message][files][{i}][name]"
-        link_key = f"data[MESSAGES][0][message][files][{i}][link]"
-        download_link_key = f"data[MESSAGES][0][message][files][{i}][downloadLink]"
-        type_key = f"data[MESSAGES][0][message][files][{i}][type]"
-        mime_key = f"data[MESSAGES][0][message][files][{i}][mime]"
-        size_key = f"data[MESSAGES][0][message][files][{i}][size]"
-        sizef_key = f"data[MESSAGES][0][message][files][{i}][sizef]"
-
-        # Проверяем, существуют ли такие ключи в словаре
-        if name_key in data and (download_link_key in data or link_key in data):
-            # Добавляем название и ссылку в список
+        item = items.get(str(i))
+        # Файлы идут по порядку, пока есть название и ссылка
+        if isinstance(item, dict) and "name" in item and ("downloadLink" in item or "link" in item):
             files.append(
                 {
-                    "name": data.get(name_key),
-                    "link": data.get(download_link_key) or data.get(link_key),
-                    "download_link": data.get(download_link_key),
-                    "source_link": data.get(link_key),
-                    "type": data.get(type_key),
-                    "mime": data.get(mime_key),
-                    "size": data.get(size_key),
-                    "sizef": data.get(sizef_key),
+                    "name": item.get("name"),
+                    "link": item.get("downloadLink") or item.get("link"),
+                    "download_link": item.get("downloadLink"),
+                    "source_link": item.get("link"),
+                    "type": item.get("type"),
+                    "mime": item.get("mime"),
+                    "size": item.get("size"),
+                    "sizef": item.get("sizef"),
                 },
             )
             i += 1
@@ -1187,7 +1192,7 @@ def bizproc_processor(data):
         except Exception as e:
             raise Exception(f"App not found: {e}")
         try:
-            appinstance = AppInstance.objects.filter(application_token=application_token).first()
+            appinstance = resolve_app_instance(application_token)
         except TRANSIENT_ERRORS:
             raise
         except Exception as e:
@@ -1300,7 +1305,7 @@ def sms_processor(self, data, service):
         )
 
     try:
-        app_instance = AppInstance.objects.filter(application_token=application_token).first()
+        app_instance = resolve_app_instance(application_token)
 
         if app_instance and app_instance.app and app_instance.app.save_events:
             Events.objects.create(
@@ -1384,8 +1389,321 @@ def sms_processor(self, data, service):
         raise
 
 
+def on_connector_message(task, appinstance, data, event):
+    user_id = data.get("auth[user_id]")
+    connector_code = data.get("data[CONNECTOR]")
+    connector = get_object_or_404(Connector, code=connector_code)
+    line_id = data.get("data[LINE]")
+    message_id = data.get("data[MESSAGES][0][im][message_id]")
+    chat_id = data.get("data[MESSAGES][0][im][chat_id]")
+    chat = data.get("data[MESSAGES][0][chat][id]")
+    send_result = None
+
+
+    file_type = data.get("data[MESSAGES][0][message][files][0][type]", None)
+    text = data.get("data[MESSAGES][0][message][text]", "")
+    command_text = ""
+
+    quoted_msg_id = None
+    if text:
+        match = re.search(r"wamid\.([a-zA-Z0-9_]+)-", text)
+        if not match:
+            # Legacy format: wamid.ID.ext
+            match = re.search(r"wamid\.([a-zA-Z0-9_]+)\.", text)
+        if match:
+            short_id = match.group(1)
+            full_id = redis_client.get(f"wamid:{short_id}")
+            if full_id:
+                quoted_msg_id = full_id.decode('utf-8')
+            else:
+                # Fallback: try using the ID directly if not found in Redis (legacy behavior)
+                quoted_msg_id = short_id
+
+        excludes_raw = appinstance.exclude or ''
+        excludes = [e.strip() for e in excludes_raw.split(",") if e.strip()]
+        if any(ex.lower() in text.lower() for ex in excludes):
+            return "message filtered"
+        text = text.replace("[br]", "\n")
+        text = re.sub(r"\[/?[a-zA-Z*][a-zA-Z0-9*]*\]|\[[a-zA-Z0-9\s]+=[^\]]+\]", "", text)
+        command_lines = [line.strip() for line in text.splitlines() if line.strip()]
+        if command_lines:
+            command_text = command_lines[-1].lower()
+
+    files = []
+    if file_type:
+        files = extract_files(data)
+
+    # If WABA connector
+    if connector.service == "waba":
+        phone = (
+            Phone.objects.select_related("line", "line__connector", "line__portal", "waba")
+            .filter(
+                line__line_id=line_id,
+                line__portal=appinstance.portal,
+                line__connector__service="waba",
+            )
+            .first()
+        )
+        if not phone:
+            error_result = {"error": True, "message": "WABA phone not found for Bitrix line"}
+            send_waba_error_to_openline(appinstance.id, chat, error_result, connector.code, line_id)
+            return error_result["message"]
+
+        if not files and command_text in ["#wa_block", "#wa_unblock"]:
+            try:
+                send_result = parse_block_command(command_text, phone, chat, appinstance.id, chat_id)
+            except Exception as e:
+                return {"error": True, "message": str(e)}
+            if "error" not in (send_result or {}):
+                send_delivery_status(appinstance.id, connector_code, line_id, chat_id, message_id)
+            return send_result
+
+        message = {
+            "messaging_product": "whatsapp",
+            "biz_opaque_callback_data": {"bitrix_user_id": user_id},
+            "to": chat,
+        }
+
+        if quoted_msg_id:
+            message["context"] = {"message_id": quoted_msg_id}
+
+        # Обработка шаблонных сообщений
+        if "template+" in text:
+            template_start = text.index("template+")
+            template_str = text[template_start:]
+            message.update(parse_template_code(template_str, appinstance=appinstance, line_id=line_id))
+
+        elif "interactive+" in text:
+            interactive_start = text.index("interactive+")
+            interactive_str = text[interactive_start:]
+            try:
+                message.update(parse_interactive_code(interactive_str, appinstance=appinstance, phone=phone))
+            except Exception as e:
+                error_result = {"error": True, "message": str(e)}
+                send_waba_error_to_openline(appinstance.id, chat, error_result, connector.code, line_id)
+                raise
+
+        elif hashtag_interactive := _get_hashtag_interactive(text, appinstance):
+            message.update(parse_interactive_code(f"interactive+{hashtag_interactive.id}", appinstance=appinstance, phone=phone))
+        elif not files and text:
+            message["type"] = "text"
+            message["text"] = {"body": text}
+
+        # Если есть файлы, отправляем сообщение с каждым файлом отдельно
+        if files:
+            media_caption = text.strip() if text else ""
+            for file in files:
+                uploaded_id = None
+                waba_file_type = _get_waba_file_type(file)
+                try:
+                    if waba_file_type == "link":
+                        logger.info("B24->WABA file as link: %s %s", file.get("name"), file.get("link"))
+                    elif appinstance.fileAsUrl:
+                        logger.info("B24->WABA file as URL: %s %s", file.get("name"), file.get("link"))
+                    else:
+                        # Reuse media uploaded from the same file URL before downloading it.
+                        uploaded_id = waba.get_cached_media_id_for_phone(phone, file["link"])
+                        if uploaded_id:
+                            logger.info("B24->WABA file cached media id: %s %s", file.get("name"), uploaded_id)
+                    if waba_file_type != "link" and not appinstance.fileAsUrl and not uploaded_id:
+                        up_res = _upload_waba_file_with_retries(phone, file)
+                        if up_res and "id" in up_res:
+                            uploaded_id = up_res["id"]
+                            logger.info("B24->WABA file streaming uploaded: %s %s", file.get("name"), uploaded_id)
+                        else:
+                            logger.info("B24->WABA file streaming upload failed: %s %s", file.get("name"), up_res)
+                except Exception as e:
+                    logger.error(f"Upload failed: {e}")
+
+                # Определяем тип файла и добавляем его к сообщению
+                if waba_file_type == "link":
+                    message["type"] = "text"
+                    link = file.get("source_link") or file.get("link") or file.get("download_link") or ""
+                    body_parts = [
+                        part for part in [
+                            file.get("name"),
+                            file.get("sizef"),
+                            link,
+                        ] if part
+                    ]
+                    body = "\n".join(body_parts)
+                    if media_caption:
+                        body = f"{media_caption}\n{body}" if body else media_caption
+                    message["text"] = {"body": body}
+                elif waba_file_type == "image":
+                    message["type"] = "image"
+                    if uploaded_id:
+                        message["image"] = {"id": uploaded_id}
+                    else:
+                        if not appinstance.fileAsUrl:
+                            logger.info("B24->WABA file fallback as URL: %s %s", file.get("name"), file.get("link"))
+                        message["image"] = {"link": file["link"]}
+                    if media_caption:
+                        message["image"]["caption"] = media_caption
+                elif waba_file_type == "video":
+                    message["type"] = "video"
+                    if uploaded_id:
+                        message["video"] = {"id": uploaded_id}
+                    else:
+                        if not appinstance.fileAsUrl:
+                            logger.info("B24->WABA file fallback as URL: %s %s", file.get("name"), file.get("link"))
+                        message["video"] = {"link": file["link"]}
+                    if media_caption:
+                        message["video"]["caption"] = media_caption
+                elif waba_file_type == "audio":
+                    message["type"] = "audio"
+                    if uploaded_id:
+                        message["audio"] = {"id": uploaded_id}
+                    else:
+                        if not appinstance.fileAsUrl:
+                            logger.info("B24->WABA file fallback as URL: %s %s", file.get("name"), file.get("link"))
+                        message["audio"] = {"link": file["link"]}
+                elif waba_file_type == "document":
+                    message["type"] = "document"
+                    if uploaded_id:
+                        message["document"] = {"id": uploaded_id, "filename": file["name"]}
+                    else:
+                        if not appinstance.fileAsUrl:
+                            logger.info("B24->WABA file fallback as URL: %s %s", file.get("name"), file.get("link"))
+                        message["document"] = {"link": file["link"], "filename": file["name"]}
+                    if media_caption:
+                        message["document"]["caption"] = media_caption
+
+                send_result = waba.send_message_from_phone(phone, message)
+                if handle_waba_send_error(task, send_result, appinstance.id, chat, connector.code, line_id):
+                    return send_result
+
+        else:
+            send_result = waba.send_message_from_phone(phone, message)
+            if handle_waba_send_error(task, send_result, appinstance.id, chat, connector.code, line_id):
+                return send_result
+
+    elif connector.service == "waweb":
+        try:
+            line = Line.objects.get(line_id=line_id, portal=appinstance.portal)
+            wa = Session.objects.get(line=line)
+            if files:
+                for file in files:
+                    waweb_tasks.send_message(str(wa.session), chat, file, 'media')
+            else:
+                send_result = waweb_tasks.send_message(wa.session, chat, text)
+        except Exception as e:
+            raise
+
+    # If OLX connector
+    elif connector.service == "olx":
+        try:
+            send_result = olx_tasks.send_message(chat, text, files)
+        except Exception as e:
+            send_error_to_openline(appinstance.id, chat, str(e), connector.code, line_id)
+            raise
+
+    send_delivery_status(appinstance.id, connector_code, line_id, chat_id, message_id)
+
+    return send_result
+
+
+def on_connector_status_delete(task, appinstance, data, event):
+    line_id = data.get("data[line]")
+    connector_code = data.get("data[connector]")
+    connector = get_object_or_404(Connector, code=connector_code)
+    line = get_object_or_404(Line, line_id=line_id, portal=appinstance.portal)
+
+    if connector.service == "olx":
+        olxuser = line.olx_users.first()
+        if olxuser:
+            olxuser.line = None
+            olxuser.save()
+
+    elif connector.service == "waba":
+        phone = line.phones.first()
+        if phone:
+            phone.line = None
+            phone.save()
+
+    elif connector.service == "waweb":
+        phone = line.wawebs.first()
+        if phone:
+            phone.line = None
+            phone.save()
+
+
+def on_connector_line_delete(task, appinstance, data, event):
+    line_id = data.get("data")
+    line = get_object_or_404(Line, line_id=line_id, portal=appinstance.portal)
+    line.delete()
+
+
+def on_external_call_start(task, appinstance, data, event):
+    try:
+        pbx = Server.objects.filter(settings__app_instance=appinstance).first()
+        b24_user_id = data.get('data[USER_ID]')
+        phone_number = data.get('data[PHONE_NUMBER_INTERNATIONAL]')
+        call_id = data.get('data[CALL_ID]')
+        payload = {
+            'event': event,
+            'b24_user_id': b24_user_id,
+            'phone_number': phone_number,
+            'call_id': call_id,
+        }
+        send_call_info(pbx.id, payload)
+    except Exception as e:
+        raise
+
+
+def on_external_callback_start(task, appinstance, data, event):
+    try:
+        pbx = Server.objects.filter(settings__app_instance=appinstance).first()
+        phone_number = data.get('data[PHONE_NUMBER]')
+        payload = {
+            'event': event,
+            'phone_number': phone_number,
+        }
+        send_call_info(pbx.id, payload)
+    except Exception as e:
+        raise
+
+
+def on_bitbot_event(task, appinstance, data, event):
+    bitbot_router.event_processor.delay(data)
+
+
+def on_app_uninstall(task, appinstance, data, event):
+    appinstance.delete()
+
+
+# Event -> (handler, queue). Every event is handled by event_processor, but
+# is queued on the lane of its kind, so a call start never waits behind file
+# uploads of connector messages. Events not listed, like ONAPPINSTALL, go to
+# the "bitrix" queue.
+EVENT_HANDLERS = {
+    "ONIMCONNECTORMESSAGEADD": (on_connector_message, "bitrix_messages"),
+    "ONIMCONNECTORSTATUSDELETE": (on_connector_status_delete, "bitrix"),
+    "ONIMCONNECTORLINEDELETE": (on_connector_line_delete, "bitrix"),
+    # AsterX
+    "ONEXTERNALCALLSTART": (on_external_call_start, "bitrix_calls"),
+    "ONEXTERNALCALLBACKSTART": (on_external_callback_start, "bitrix_calls"),
+    # BitBot
+    "ONIMBOTMESSAGEADD": (on_bitbot_event, "bitrix"),
+    "ONIMCOMMANDADD": (on_bitbot_event, "bitrix"),
+    "ONIMBOTJOINCHAT": (on_bitbot_event, "bitrix"),
+    "ONAPPUNINSTALL": (on_app_uninstall, "bitrix"),
+}
+
+
+def event_queue(data):
+    event = (data.get("event") or "").upper()
+    _, queue = EVENT_HANDLERS.get(event, (None, "bitrix"))
+    return queue
+
+
+def dispatch_event(data):
+    return event_processor.apply_async(args=[data], queue=event_queue(data))
+
+
 @shared_task(bind=True, queue='bitrix', **RETRY_KWARGS)
 def event_processor(self, data):
+    data = parse_event(data)
     try:
         event = data.get("event").upper()
         domain = data.get("auth[domain]")
@@ -1458,11 +1776,10 @@ def event_processor(self, data):
                     errors.append(f"queue_app_features: {e}")
                 
                 if app.connectors.exists():
-                    for connector in app.connectors.all():
-                        try:
-                            register_connector(appinstance, connector)
-                        except Exception as e:
-                            errors.append(f"register_connector {connector.id}: {e}")
+                    try:
+                        register_connectors(appinstance, app.connectors.all())
+                    except Exception as e:
+                        errors.append(f"register_connectors: {e}")
 
                 if errors:
                     raise Exception("; ".join(errors))
@@ -1494,7 +1811,9 @@ def event_processor(self, data):
             }
             bitrix_tasks.call_api.delay(appinstance.id, "im.notify.system.add", payload)
         else:
-            appinstance = AppInstance.objects.get(application_token=application_token)
+            appinstance = resolve_app_instance(application_token)
+            if appinstance is None:
+                raise AppInstance.DoesNotExist(f"AppInstance not found for token {application_token}")
 
         if appinstance and appinstance.app and appinstance.app.save_events:
             Events.objects.create(
@@ -1503,282 +1822,9 @@ def event_processor(self, data):
                 content=json.dumps(data, ensure_ascii=False, default=str),
             )
         
-        if event == "ONIMCONNECTORMESSAGEADD":
-            connector_code = data.get("data[CONNECTOR]")
-            connector = get_object_or_404(Connector, code=connector_code)
-            line_id = data.get("data[LINE]")
-            message_id = data.get("data[MESSAGES][0][im][message_id]")
-            chat_id = data.get("data[MESSAGES][0][im][chat_id]")
-            chat = data.get("data[MESSAGES][0][chat][id]")
-            send_result = None
-
-            
-            file_type = data.get("data[MESSAGES][0][message][files][0][type]", None)
-            text = data.get("data[MESSAGES][0][message][text]", "")
-            command_text = ""
-            
-            quoted_msg_id = None
-            if text:
-                match = re.search(r"wamid\.([a-zA-Z0-9_]+)-", text)
-                if not match:
-                    # Legacy format: wamid.ID.ext
-                    match = re.search(r"wamid\.([a-zA-Z0-9_]+)\.", text)
-                if match:
-                    short_id = match.group(1)
-                    full_id = redis_client.get(f"wamid:{short_id}")
-                    if full_id:
-                        quoted_msg_id = full_id.decode('utf-8')
-                    else:
-                        # Fallback: try using the ID directly if not found in Redis (legacy behavior)
-                        quoted_msg_id = short_id
-
-                excludes_raw = appinstance.exclude or ''
-                excludes = [e.strip() for e in excludes_raw.split(",") if e.strip()]
-                if any(ex.lower() in text.lower() for ex in excludes):
-                    return "message filtered"
-                text = text.replace("[br]", "\n")
-                text = re.sub(r"\[/?[a-zA-Z*][a-zA-Z0-9*]*\]|\[[a-zA-Z0-9\s]+=[^\]]+\]", "", text)
-                command_lines = [line.strip() for line in text.splitlines() if line.strip()]
-                if command_lines:
-                    command_text = command_lines[-1].lower()
-
-            files = []
-            if file_type:
-                files = extract_files(data)
-            
-            # If WABA connector
-            if connector.service == "waba":
-                phone = (
-                    Phone.objects.select_related("line", "line__connector", "line__portal", "waba")
-                    .filter(
-                        line__line_id=line_id,
-                        line__portal=appinstance.portal,
-                        line__connector__service="waba",
-                    )
-                    .first()
-                )
-                if not phone:
-                    error_result = {"error": True, "message": "WABA phone not found for Bitrix line"}
-                    send_waba_error_to_openline(appinstance.id, chat, error_result, connector.code, line_id)
-                    return error_result["message"]
-
-                if not files and command_text in ["#wa_block", "#wa_unblock"]:
-                    try:
-                        send_result = parse_block_command(command_text, phone, chat, appinstance.id, chat_id)
-                    except Exception as e:
-                        return {"error": True, "message": str(e)}
-                    if "error" not in (send_result or {}):
-                        send_delivery_status(appinstance.id, connector_code, line_id, chat_id, message_id)
-                    return send_result
-
-                message = {
-                    "messaging_product": "whatsapp",
-                    "biz_opaque_callback_data": {"bitrix_user_id": user_id},
-                    "to": chat,
-                }
-                
-                if quoted_msg_id:
-                    message["context"] = {"message_id": quoted_msg_id}
-
-                # Обработка шаблонных сообщений
-                if "template+" in text:
-                    template_start = text.index("template+")
-                    template_str = text[template_start:]
-                    message.update(parse_template_code(template_str, appinstance=appinstance, line_id=line_id))
-
-                elif "interactive+" in text:
-                    interactive_start = text.index("interactive+")
-                    interactive_str = text[interactive_start:]
-                    try:
-                        message.update(parse_interactive_code(interactive_str, appinstance=appinstance, phone=phone))
-                    except Exception as e:
-                        error_result = {"error": True, "message": str(e)}
-                        send_waba_error_to_openline(appinstance.id, chat, error_result, connector.code, line_id)
-                        raise
-
-                elif hashtag_interactive := _get_hashtag_interactive(text, appinstance):
-                    message.update(parse_interactive_code(f"interactive+{hashtag_interactive.id}", appinstance=appinstance, phone=phone))
-                elif not files and text:
-                    message["type"] = "text"
-                    message["text"] = {"body": text}
-
-                # Если есть файлы, отправляем сообщение с каждым файлом отдельно
-                if files:
-                    media_caption = text.strip() if text else ""
-                    for file in files:
-                        uploaded_id = None
-                        waba_file_type = _get_waba_file_type(file)
-                        try:
-                            if waba_file_type == "link":
-                                logger.info("B24->WABA file as link: %s %s", file.get("name"), file.get("link"))
-                            elif appinstance.fileAsUrl:
-                                logger.info("B24->WABA file as URL: %s %s", file.get("name"), file.get("link"))
-                            else:
-                                # Reuse media uploaded from the same file URL before downloading it.
-                                uploaded_id = waba.get_cached_media_id_for_phone(phone, file["link"])
-                                if uploaded_id:
-                                    logger.info("B24->WABA file cached media id: %s %s", file.get("name"), uploaded_id)
-                            if waba_file_type != "link" and not appinstance.fileAsUrl and not uploaded_id:
-                                up_res = _upload_waba_file_with_retries(phone, file)
-                                if up_res and "id" in up_res:
-                                    uploaded_id = up_res["id"]
-                                    logger.info("B24->WABA file streaming uploaded: %s %s", file.get("name"), uploaded_id)
-                                else:
-                                    logger.info("B24->WABA file streaming upload failed: %s %s", file.get("name"), up_res)
-                        except Exception as e:
-                            logger.error(f"Upload failed: {e}")
-
-                        # Определяем тип файла и добавляем его к сообщению
-                        if waba_file_type == "link":
-                            message["type"] = "text"
-                            link = file.get("source_link") or file.get("link") or file.get("download_link") or ""
-                            body_parts = [
-                                part for part in [
-                                    file.get("name"),
-                                    file.get("sizef"),
-                                    link,
-                                ] if part
-                            ]
-                            body = "\n".join(body_parts)
-                            if media_caption:
-                                body = f"{media_caption}\n{body}" if body else media_caption
-                            message["text"] = {"body": body}
-                        elif waba_file_type == "image":
-                            message["type"] = "image"
-                            if uploaded_id:
-                                message["image"] = {"id": uploaded_id}
-                            else:
-                                if not appinstance.fileAsUrl:
-                                    logger.info("B24->WABA file fallback as URL: %s %s", file.get("name"), file.get("link"))
-                                message["image"] = {"link": file["link"]}
-                            if media_caption:
-                                message["image"]["caption"] = media_caption
-                        elif waba_file_type == "video":
-                            message["type"] = "video"
-                            if uploaded_id:
-                                message["video"] = {"id": uploaded_id}
-                            else:
-                                if not appinstance.fileAsUrl:
-                                    logger.info("B24->WABA file fallback as URL: %s %s", file.get("name"), file.get("link"))
-                                message["video"] = {"link": file["link"]}
-                            if media_caption:
-                                message["video"]["caption"] = media_caption
-                        elif waba_file_type == "audio":
-                            message["type"] = "audio"
-                            if uploaded_id:
-                                message["audio"] = {"id": uploaded_id}
-                            else:
-                                if not appinstance.fileAsUrl:
-                                    logger.info("B24->WABA file fallback as URL: %s %s", file.get("name"), file.get("link"))
-                                message["audio"] = {"link": file["link"]}
-                        elif waba_file_type == "document":
-                            message["type"] = "document"
-                            if uploaded_id:
-                                message["document"] = {"id": uploaded_id, "filename": file["name"]}
-                            else:
-                                if not appinstance.fileAsUrl:
-                                    logger.info("B24->WABA file fallback as URL: %s %s", file.get("name"), file.get("link"))
-                                message["document"] = {"link": file["link"], "filename": file["name"]}
-                            if media_caption:
-                                message["document"]["caption"] = media_caption
-
-                        send_result = waba.send_message_from_phone(phone, message)
-                        if handle_waba_send_error(self, send_result, appinstance.id, chat, connector.code, line_id):
-                            return send_result
-
-                else:
-                    send_result = waba.send_message_from_phone(phone, message)
-                    if handle_waba_send_error(self, send_result, appinstance.id, chat, connector.code, line_id):
-                        return send_result
-
-            elif connector.service == "waweb":
-                try:
-                    line = Line.objects.get(line_id=line_id, portal=appinstance.portal)
-                    wa = Session.objects.get(line=line)
-                    if files:
-                        for file in files:
-                            waweb_tasks.send_message(str(wa.session), chat, file, 'media')
-                    else:
-                        send_result = waweb_tasks.send_message(wa.session, chat, text)
-                except Exception as e:
-                    raise
-
-            # If OLX connector
-            elif connector.service == "olx":
-                try:
-                    send_result = olx_tasks.send_message(chat, text, files)
-                except Exception as e:
-                    send_error_to_openline(appinstance.id, chat, str(e), connector.code, line_id)
-                    raise
-
-            send_delivery_status(appinstance.id, connector_code, line_id, chat_id, message_id)
-
-            return send_result
-        
-        elif event == "ONIMCONNECTORSTATUSDELETE":
-            line_id = data.get("data[line]")
-            connector_code = data.get("data[connector]")
-            connector = get_object_or_404(Connector, code=connector_code)
-            line = get_object_or_404(Line, line_id=line_id, portal=appinstance.portal)
-
-            if connector.service == "olx":
-                olxuser = line.olx_users.first()
-                if olxuser:
-                    olxuser.line = None
-                    olxuser.save()
-
-            elif connector.service == "waba":
-                phone = line.phones.first()
-                if phone:
-                    phone.line = None
-                    phone.save()
-            
-            elif connector.service == "waweb":
-                phone = line.wawebs.first()
-                if phone:
-                    phone.line = None
-                    phone.save()
-
-        elif event == "ONIMCONNECTORLINEDELETE":
-            line_id = data.get("data")
-            line = get_object_or_404(Line, line_id=line_id, portal=appinstance.portal)
-            line.delete()
-            
-        # AsterX
-        elif event == "ONEXTERNALCALLSTART":
-            try:
-                pbx = Server.objects.filter(settings__app_instance=appinstance).first()
-                b24_user_id = data.get('data[USER_ID]')
-                phone_number = data.get('data[PHONE_NUMBER_INTERNATIONAL]')
-                call_id = data.get('data[CALL_ID]')
-                payload = {
-                    'event': event,
-                    'b24_user_id': b24_user_id,
-                    'phone_number': phone_number,
-                    'call_id': call_id,
-                }
-                send_call_info(pbx.id, payload)
-            except Exception as e:
-                raise
-        
-        elif event == "ONEXTERNALCALLBACKSTART":
-            try:
-                pbx = Server.objects.filter(settings__app_instance=appinstance).first()
-                phone_number = data.get('data[PHONE_NUMBER]')
-                payload = {
-                    'event': event,
-                    'phone_number': phone_number,
-                }
-                send_call_info(pbx.id, payload)
-            except Exception as e:
-                raise
-
-        # BitBot
-        elif event in ["ONIMBOTMESSAGEADD", "ONIMCOMMANDADD", "ONIMBOTJOINCHAT"]:
-            bitbot_router.event_processor.delay(data)
-
-        elif event == "ONAPPUNINSTALL":
-            appinstance.delete()
+        handler, _ = EVENT_HANDLERS.get(event, (None, None))
+        if handler:
+            return handler(self, appinstance, data, event)
 
     except TRANSIENT_ERRORS:
         raise
@@ -5,6 +5,10 @@ from redis.exceptions import ConnectionError as RedisConnectionError
 from redis.exceptions import ReadOnlyError as RedisReadOnlyError
 from redis.exceptions import TimeoutError as RedisTimeoutError
 
+from separator.bitrix.circuit import BitrixCircuitOpenError
+from separator.bitrix.ratelimit import BitrixRateLimitError
+from separator.bitrix.retry import RetryAfterTask
+
 
 TRANSIENT_ERRORS = (
     requests.RequestException,
@@ -15,9 +19,14 @@ TRANSIENT_ERRORS = (
     RedisTimeoutError,
     RedisReadOnlyError,
     KombuOperationalError,
+    # Raised by the Bitrix calls WABA tasks make; the message is kept and
+    # retried once the portal's circuit closes or its rate limit allows.
+    BitrixCircuitOpenError,
+    BitrixRateLimitError,
 )
 
 RETRY_KWARGS = {
+    "base": RetryAfterTask,
     "autoretry_for": TRANSIENT_ERRORS,
     "retry_backoff": 5,
     "retry_backoff_max": 600,
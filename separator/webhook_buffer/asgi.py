@@ -0,0 +1,153 @@
+import asyncio
+
+import redis
+import redis.asyncio
+from redis.client import NEVER_DECODE
+
+from . import config, metrics
+from .dedupe import ADD_ONCE, add_args, event_key
+from .ingress import (
+    BacklogCache,
+    accepts,
+    build,
+    headers_from_scope,
+    is_metrics_request,
+    is_overloaded,
+    response,
+)
+
+
+# Requests beyond the pool size wait for a free connection instead of
+# failing, so one process can hold thousands of concurrent webhooks.
+redis_client = redis.asyncio.Redis(
+    connection_pool=redis.asyncio.BlockingConnectionPool.from_url(
+        config.REDIS_URL,
+        decode_responses=True,
+        max_connections=config.ASGI_REDIS_MAX_CONNECTIONS,
+        timeout=config.REDIS_CONNECT_TIMEOUT,
+    )
+)
+add_once_script = redis_client.register_script(ADD_ONCE)
+backlog_cache = BacklogCache()
+
+# The metrics collector is synchronous; it gets its own client and runs in a
+# thread so a scrape never blocks the event loop.
+_metrics_client = None
+
+
+async def get_backlog(stream):
+    backlog = backlog_cache.get(stream)
+    if backlog is not None:
+        return backlog
+
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.xlen(stream)
+        # Raw bytes: a compressed binary envelope is not valid UTF-8, and only
+        # the entry id is needed.
+        pipe.execute_command("XRANGE", stream, "-", "+", "COUNT", 1, **{NEVER_DECODE: True})
+        length, oldest = await pipe.execute()
+    return backlog_cache.update(stream, length, oldest)
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def send_response(send, status, headers, body):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": int(status.split(" ", 1)[0]),
+            "headers": [
+                (name.lower().encode("latin-1"), value.encode("latin-1"))
+                for name, value in headers
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def render_metrics():
+    global _metrics_client
+
+    if _metrics_client is None:
+        # Raw bytes: compressed stream entries are not valid UTF-8.
+        _metrics_client = redis.Redis.from_url(config.REDIS_URL)
+    return await asyncio.to_thread(metrics.render, _metrics_client)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await redis_client.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    method = scope.get("method", "")
+    path = scope.get("path", "")
+
+    if is_metrics_request(method, path):
+        content_type, output = await render_metrics()
+        await send_response(send, "200 OK", [("Content-Type", content_type)], output)
+        return
+
+    if not accepts(method, path):
+        await send_response(send, *response(path, "not_found"))
+        return
+
+    body = await read_body(receive)
+    if body is None:
+        return
+    query = scope.get("query_string", b"").decode("latin-1")
+    headers = headers_from_scope(scope)
+    stream, message = build(method, path, query, headers, body)
+
+    try:
+        backlog = await get_backlog(stream)
+    except Exception:
+        backlog = (0, 0.0)
+
+    if is_overloaded(backlog):
+        await send_response(send, *response(path, "shed", backlog))
+        return
+
+    try:
+        if config.DEDUPE_TTL:
+            added = await add_once_script(
+                keys=[stream, event_key(path, query, body)],
+                args=add_args(message),
+            )
+        else:
+            added = await redis_client.xadd(
+                stream,
+                message,
+                maxlen=config.STREAM_MAXLEN or None,
+                approximate=True,
+            )
+    except Exception:
+        await send_response(send, *response(path, "error"))
+        return
+
+    if not added:
+        # Already buffered: acknowledge the redelivery without storing it.
+        await send_response(send, *response(path, "duplicate", backlog))
+        return
+    await send_response(send, *response(path, "accepted", backlog))
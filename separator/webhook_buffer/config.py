@@ -15,6 +15,13 @@ def env_int(name, default):
         return default
 
 
+def env_bool(name, default):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
 def env_float(name, default):
     value = os.environ.get(name)
     if value is None:
@@ -27,7 +34,21 @@ def env_float(name, default):
 
 REDIS_URL = env("WEBHOOK_BUFFER_REDIS_URL", "redis://127.0.0.1:6381/0")
 STREAM = env("WEBHOOK_BUFFER_STREAM", "webhook:incoming")
+STREAM_SHARDS = max(1, env_int("WEBHOOK_BUFFER_STREAM_SHARDS", 1))
 DEAD_STREAM = env("WEBHOOK_BUFFER_DEAD_STREAM", "webhook:dead")
+RETRY_ZSET = env("WEBHOOK_BUFFER_RETRY_ZSET", "webhook:retry")
+
+STREAM_MAXLEN = env_int("WEBHOOK_BUFFER_STREAM_MAXLEN", 0)
+BACKLOG_HIGH_WATER = env_int("WEBHOOK_BUFFER_BACKLOG_HIGH_WATER", 0)
+BACKLOG_CHECK_MS = env_int("WEBHOOK_BUFFER_BACKLOG_CHECK_MS", 1000)
+BACKLOG_RETRY_AFTER = env_int("WEBHOOK_BUFFER_BACKLOG_RETRY_AFTER", 60)
+
+DEDUPE_TTL = env_int("WEBHOOK_BUFFER_DEDUPE_TTL", 0)
+DEDUPE_PREFIX = env("WEBHOOK_BUFFER_DEDUPE_PREFIX", "webhook:seen:")
+
+ENVELOPE = env("WEBHOOK_BUFFER_ENVELOPE", "json")
+COMPRESSION = env("WEBHOOK_BUFFER_COMPRESSION", "")
+COMPRESS_MIN_SIZE = env_int("WEBHOOK_BUFFER_COMPRESS_MIN_SIZE", 1024)
 
 PATHS = {
     path.strip()
@@ -42,16 +63,36 @@ FORWARD_URL = env("WEBHOOK_FORWARD_URL", "http://127.0.0.1:8000")
 FORWARD_UNIX_SOCKET = env("WEBHOOK_FORWARD_UNIX_SOCKET", "")
 FORWARD_GROUP = env("WEBHOOK_FORWARD_GROUP", "webhook-forwarders")
 FORWARD_CONSUMER = env("WEBHOOK_FORWARD_CONSUMER", "worker-1")
+FORWARD_SHARDS = env("WEBHOOK_FORWARD_SHARDS", "")
 FORWARD_TIMEOUT = env_float("WEBHOOK_FORWARD_TIMEOUT", 20.0)
 FORWARD_MAX_RETRIES = env_int("WEBHOOK_FORWARD_MAX_RETRIES", 20)
 FORWARD_RETRY_DELAY = env_float("WEBHOOK_FORWARD_RETRY_DELAY", 3.0)
+FORWARD_RETRY_MAX_DELAY = env_float("WEBHOOK_FORWARD_RETRY_MAX_DELAY", 60.0)
+FORWARD_RETRY_POLL_MS = env_int("WEBHOOK_FORWARD_RETRY_POLL_MS", 1000)
 FORWARD_BATCH_SIZE = env_int("WEBHOOK_FORWARD_BATCH_SIZE", 10)
+FORWARD_CONCURRENCY = max(1, env_int("WEBHOOK_FORWARD_CONCURRENCY", 1))
+FORWARD_POOL_SIZE = max(1, env_int("WEBHOOK_FORWARD_POOL_SIZE", FORWARD_CONCURRENCY))
 FORWARD_BLOCK_MS = env_int("WEBHOOK_FORWARD_BLOCK_MS", 5000)
 FORWARD_PENDING_IDLE_MS = env_int("WEBHOOK_FORWARD_PENDING_IDLE_MS", 60000)
+FORWARD_CLAIM_INTERVAL_MS = env_int("WEBHOOK_FORWARD_CLAIM_INTERVAL_MS", 10000)
+
+METRICS_PATH = env("WEBHOOK_BUFFER_METRICS_PATH", "")
+METRICS_PORT = env_int("WEBHOOK_FORWARD_METRICS_PORT", 0)
+
+DISPATCH_MODE = env("WEBHOOK_DISPATCH_MODE", "http")
+DISPATCH_BROKER_URL = env(
+    "WEBHOOK_DISPATCH_BROKER_URL",
+    env("CELERY_BROKER_URL", "redis://127.0.0.1:6379/0"),
+)
+DISPATCH_WABA_EVENTS_SEPARATOR = env_bool(
+    "WEBHOOK_DISPATCH_WABA_EVENTS_SEPARATOR",
+    env_bool("WABA_EVENTS_SEPARATOR", False),
+)
 
 REDIS_CONNECT_TIMEOUT = env_float("WEBHOOK_BUFFER_REDIS_CONNECT_TIMEOUT", 5.0)
 REDIS_SOCKET_TIMEOUT = env_float(
     "WEBHOOK_BUFFER_REDIS_SOCKET_TIMEOUT",
     max(10.0, FORWARD_BLOCK_MS / 1000.0 + 5.0),
 )
+ASGI_REDIS_MAX_CONNECTIONS = env_int("WEBHOOK_BUFFER_ASGI_REDIS_MAX_CONNECTIONS", 50)
 REDIS_HEALTH_CHECK_INTERVAL = env_int("WEBHOOK_BUFFER_REDIS_HEALTH_CHECK_INTERVAL", 30)
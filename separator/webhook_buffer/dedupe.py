@@ -0,0 +1,89 @@
+import hashlib
+import json
+from urllib.parse import parse_qsl
+
+from . import config
+
+
+# Marks the webhook as seen and appends it to the stream in one step, so a
+# redelivery racing the original can never be buffered twice.
+ADD_ONCE = """
+if not redis.call("SET", KEYS[2], "1", "NX", "EX", ARGV[1]) then
+    return false
+end
+if tonumber(ARGV[2]) > 0 then
+    return redis.call("XADD", KEYS[1], "MAXLEN", "~", ARGV[2], "*", unpack(ARGV, 3))
+end
+return redis.call("XADD", KEYS[1], "*", unpack(ARGV, 3))
+"""
+
+
+def waba_event_ids(body):
+    # wamids of inbound messages, and wamid + status for status updates,
+    # since one message goes through sent/delivered/read with the same id.
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return []
+    if not isinstance(data, dict):
+        return []
+
+    ids = []
+    for entry in data.get("entry") or []:
+        for change in entry.get("changes") or []:
+            value = change.get("value") or {}
+            for message in value.get("messages") or []:
+                if message.get("id"):
+                    ids.append(f"message:{message['id']}")
+            for status in value.get("statuses") or []:
+                if status.get("id"):
+                    ids.append(f"status:{status['id']}:{status.get('status')}")
+    return ids
+
+
+def bitrix_event_ids(path, body):
+    try:
+        fields = parse_qsl(body.decode("utf-8"), keep_blank_values=True)
+    except UnicodeDecodeError:
+        return []
+
+    data = dict(fields)
+    member_id = data.get("auth[member_id]", "")
+    if path == "/api/bitrix/sms/":
+        ids = [data.get("message_id")]
+    elif path == "/api/bitrix/bizproc/":
+        ids = [data.get("event_token")]
+    else:
+        ids = [
+            value
+            for key, value in fields
+            if key.startswith("data[MESSAGES]") and key.endswith("[im][message_id]")
+        ]
+        event = data.get("event", "").upper()
+        ids = [f"{event}:{value}" for value in ids if value]
+    return [f"{member_id}:{value}" for value in ids if value]
+
+
+def event_key(path, query, body):
+    if path == "/api/waba/":
+        ids = waba_event_ids(body)
+    elif path.startswith("/api/bitrix/"):
+        ids = bitrix_event_ids(path, body)
+    else:
+        ids = []
+
+    digest = hashlib.sha256()
+    if ids:
+        digest.update("|".join(sorted(ids)).encode("utf-8"))
+    else:
+        # No provider event id: a redelivery carries the same request.
+        digest.update(f"{path}?{query}\n".encode("utf-8"))
+        digest.update(body)
+    return f"{config.DEDUPE_PREFIX}{path}:{digest.hexdigest()}"
+
+
+def add_args(message):
+    args = [config.DEDUPE_TTL, config.STREAM_MAXLEN]
+    for key, value in message.items():
+        args.extend((key, value))
+    return args
@@ -0,0 +1,131 @@
+import json
+import threading
+from urllib.parse import parse_qsl
+
+try:
+    from celery import Celery
+except ImportError:
+    Celery = None
+
+from . import config
+
+
+_app = None
+_app_lock = threading.Lock()
+
+
+def get_app():
+    global _app
+
+    if Celery is None:
+        raise RuntimeError("celery is required for direct dispatch")
+    if _app is None:
+        with _app_lock:
+            if _app is None:
+                app = Celery("separator", broker=config.DISPATCH_BROKER_URL)
+                app.conf.task_serializer = "json"
+                _app = app
+    return _app
+
+
+def query_value(query, name):
+    # Mirrors request.query_params.get(): the last value wins.
+    value = None
+    for key, item in parse_qsl(query, keep_blank_values=True):
+        if key == name:
+            value = item
+    return value
+
+
+def form_data(entry):
+    # The Bitrix views pass request.data, which Celery serializes as a plain
+    # dict holding the last value of every form field.
+    content_type = entry["headers"].get("Content-Type", "")
+    if not content_type.startswith("application/x-www-form-urlencoded"):
+        return None
+    return dict(parse_qsl(entry["body"].decode("utf-8"), keep_blank_values=True))
+
+
+# Same lanes as separator.bitrix.utils.EVENT_HANDLERS; other events go to
+# the "bitrix" queue.
+BITRIX_EVENT_QUEUES = {
+    "ONIMCONNECTORMESSAGEADD": "bitrix_messages",
+    "ONEXTERNALCALLSTART": "bitrix_calls",
+    "ONEXTERNALCALLBACKSTART": "bitrix_calls",
+}
+
+
+def bitrix_event_queue(data):
+    event = (data.get("event") or "").upper()
+    return BITRIX_EVENT_QUEUES.get(event, "bitrix")
+
+
+def waba_task(raw_body):
+    # Same routing as WabaWebhook.create.
+    if not config.DISPATCH_WABA_EVENTS_SEPARATOR:
+        return "separator.waba.utils.event_processing", "waba"
+    try:
+        data = json.loads(raw_body)
+        entry = data.get("entry", [{}])[0]
+        changes = entry.get("changes", [{}])
+        if changes:
+            change = changes[0]
+            field = change.get("field")
+            value = change.get("value", {})
+            if (
+                (field == "messages" and value.get("messages"))
+                or field == "smb_message_echoes"
+            ):
+                return "separator.waba.utils.messages_processing", "waba_messages"
+    except Exception:
+        pass
+    return "separator.waba.utils.event_processing", "waba"
+
+
+def route(entry):
+    # Returns (task name, args, kwargs, queue) following the same rules as
+    # the Django views, or None when the entry has to go over HTTP.
+    path = entry["path"]
+
+    if path in ("/api/bitrix/", "/api/bitrix/sms/", "/api/bitrix/bizproc/"):
+        data = form_data(entry)
+        if data is None:
+            return None
+        if path == "/api/bitrix/":
+            return (
+                "separator.bitrix.utils.event_processor",
+                [data],
+                {},
+                bitrix_event_queue(data),
+            )
+        if path == "/api/bitrix/sms/":
+            service = query_value(entry["query"], "service")
+            return (
+                "separator.bitrix.utils.sms_processor",
+                [data, service],
+                {},
+                "bitrix",
+            )
+        return "separator.bitrix.utils.bizproc_processor", [data], {}, "bitrix"
+
+    if path == "/api/waba/":
+        raw_body = entry["body"].decode("utf-8")
+        name, queue = waba_task(raw_body)
+        kwargs = {
+            "raw_body": raw_body,
+            "signature": entry["headers"].get("X-Hub-Signature-256"),
+            "app_id": query_value(entry["query"], "app_id"),
+            "host": entry["headers"].get("Host"),
+        }
+        return name, [], kwargs, queue
+
+    return None
+
+
+def dispatch(entry):
+    target = route(entry)
+    if target is None:
+        return False
+    name, args, kwargs, queue = target
+    get_app().send_task(name, args=args, kwargs=kwargs, queue=queue)
+    return True
@@ -0,0 +1,100 @@
+import base64
+import json
+from urllib.parse import parse_qsl
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+from . import config
+
+
+# Entries written with the binary envelope carry this version field. Entries
+# without it use the original JSON/base64 layout, so both can coexist in a
+# stream during a rollout.
+BINARY_VERSION = b"2"
+
+if config.COMPRESSION == "zstd" and zstandard is None:
+    raise RuntimeError("zstandard is required for zstd compression")
+if config.COMPRESSION == "lz4" and lz4_frame is None:
+    raise RuntimeError("lz4 is required for lz4 compression")
+
+
+def compress(body):
+    if len(body) < config.COMPRESS_MIN_SIZE:
+        return "", body
+    if config.COMPRESSION == "zstd":
+        return "zstd", zstandard.ZstdCompressor().compress(body)
+    if config.COMPRESSION == "lz4":
+        return "lz4", lz4_frame.compress(body)
+    return "", body
+
+
+def decompress(encoding, payload):
+    if not encoding:
+        return payload
+    if encoding == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is required for zstd compression")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    if encoding == "lz4":
+        if lz4_frame is None:
+            raise RuntimeError("lz4 is required for lz4 compression")
+        return lz4_frame.decompress(payload)
+    raise ValueError(f"Unknown webhook body encoding: {encoding}")
+
+
+def encode(method, path, query, headers, body, created_at):
+    if config.ENVELOPE != "binary":
+        return {
+            "method": method,
+            "path": path,
+            "query": query,
+            "query_params": json.dumps(parse_qsl(query, keep_blank_values=True)),
+            "headers": json.dumps(headers),
+            "body": base64.b64encode(body).decode("ascii"),
+            "created_at": str(created_at),
+            "retry_count": "0",
+        }
+
+    encoding, payload = compress(body)
+    return {
+        "v": BINARY_VERSION,
+        "method": method,
+        "path": path,
+        "query": query,
+        "headers": json.dumps(headers, separators=(",", ":")),
+        "body": payload,
+        "encoding": encoding,
+        "created_at": str(created_at),
+        "retry_count": "0",
+    }
+
+
+def text(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return value or ""
+
+
+def decode(data):
+    # Accepts stream entry fields with str keys and str or bytes values.
+    body = data.get("body") or b""
+    if data.get("v") in (BINARY_VERSION, BINARY_VERSION.decode()):
+        body = decompress(text(data.get("encoding")), body)
+    else:
+        body = base64.b64decode(body)
+
+    return {
+        "method": text(data.get("method")),
+        "path": text(data.get("path")),
+        "query": text(data.get("query")),
+        "headers": json.loads(text(data.get("headers")) or "{}"),
+        "body": body,
+    }
@@ -0,0 +1,113 @@
+import time
+
+from . import config, metrics
+from .envelope import encode, text
+from .shards import shard_for, stream_name
+
+
+RESPONSES = {
+    "accepted": ("202 Accepted", b"ok"),
+    "duplicate": ("200 OK", b"duplicate"),
+    "shed": ("503 Service Unavailable", b"backlog full"),
+    "error": ("503 Service Unavailable", b"redis unavailable"),
+    "not_found": ("404 Not Found", b"not found"),
+}
+
+
+def accepts(method, path):
+    return method == "POST" and path in config.PATHS
+
+
+def is_metrics_request(method, path):
+    return (
+        bool(config.METRICS_PATH)
+        and method == "GET"
+        and path == config.METRICS_PATH
+    )
+
+
+def headers_from_environ(environ):
+    headers = {}
+    for key, value in environ.items():
+        if key.startswith("HTTP_"):
+            header = key[5:].replace("_", "-").title()
+            headers[header] = value
+    if environ.get("CONTENT_TYPE"):
+        headers["Content-Type"] = environ["CONTENT_TYPE"]
+    if environ.get("CONTENT_LENGTH"):
+        headers["Content-Length"] = environ["CONTENT_LENGTH"]
+    return headers
+
+
+def headers_from_scope(scope):
+    # Same names as the WSGI environ produces; repeated headers are joined
+    # the way Gunicorn joins them.
+    headers = {}
+    for name, value in scope.get("headers") or []:
+        header = name.decode("latin-1").replace("_", "-").title()
+        value = value.decode("latin-1")
+        if header in headers:
+            headers[header] = f"{headers[header]},{value}"
+        else:
+            headers[header] = value
+    return headers
+
+
+def build(method, path, query, headers, body):
+    message = encode(method, path, query, headers, body, time.time())
+    stream = stream_name(shard_for(path, query, body))
+    return stream, message
+
+
+def is_overloaded(backlog):
+    return (
+        bool(config.BACKLOG_HIGH_WATER)
+        and backlog[0] >= config.BACKLOG_HIGH_WATER
+    )
+
+
+class BacklogCache:
+    # Per-process cache of stream -> (length, lag seconds, checked at), so
+    # the backlog is measured at most once per WEBHOOK_BUFFER_BACKLOG_CHECK_MS.
+
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, stream):
+        cached = self.entries.get(stream)
+        max_age = config.BACKLOG_CHECK_MS / 1000.0
+        if cached and time.monotonic() - cached[2] < max_age:
+            return cached[0], cached[1]
+        return None
+
+    def update(self, stream, length, oldest):
+        lag = 0.0
+        if oldest:
+            # Entry ids start with the millisecond timestamp they were added at.
+            oldest_ms = int(text(oldest[0][0]).split("-")[0])
+            lag = max(0.0, time.time() - oldest_ms / 1000.0)
+        self.entries[stream] = (length, lag, time.monotonic())
+        return length, lag
+
+
+def backlog_headers(backlog):
+    length, lag = backlog
+    return [
+        ("X-Webhook-Buffer-Backlog", str(length)),
+        ("X-Webhook-Buffer-Lag", f"{lag:.1f}"),
+    ]
+
+
+def response(path, result, backlog=None):
+    # Unknown paths are not used as a label to keep cardinality bounded.
+    metrics.INGRESS_REQUESTS.labels(
+        "" if result == "not_found" else path, result
+    ).inc()
+
+    status, body = RESPONSES[result]
+    headers = [("Content-Type", "text/plain")]
+    if result == "shed":
+        headers.append(("Retry-After", str(config.BACKLOG_RETRY_AFTER)))
+    if backlog is not None and result != "error":
+        headers.extend(backlog_headers(backlog))
+    return status, headers, body
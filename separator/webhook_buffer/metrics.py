@@ -0,0 +1,190 @@
+import os
+import time
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+    from prometheus_client.core import GaugeMetricFamily
+except ImportError:
+    prometheus_client = None
+
+from . import config
+from .shards import retry_zset_name, stream_name
+
+
+if (config.METRICS_PORT or config.METRICS_PATH) and prometheus_client is None:
+    raise RuntimeError("prometheus-client is required for webhook buffer metrics")
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20)
+LAG_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 900, 1800, 3600, 21600)
+
+
+class NoopMetric:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, amount):
+        pass
+
+
+def counter(name, documentation, labelnames=()):
+    if prometheus_client is None:
+        return NoopMetric()
+    return prometheus_client.Counter(name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    if prometheus_client is None:
+        return NoopMetric()
+    return prometheus_client.Histogram(
+        name, documentation, labelnames, buckets=buckets
+    )
+
+
+INGRESS_REQUESTS = counter(
+    "webhook_buffer_ingress_requests_total",
+    "Webhook requests received by the buffer endpoint.",
+    ["path", "result"],
+)
+FORWARDED = counter(
+    "webhook_buffer_forwarded_total",
+    "Webhooks delivered by the worker.",
+    ["path", "via"],
+)
+FORWARD_FAILURES = counter(
+    "webhook_buffer_forward_failures_total",
+    "Failed webhook delivery attempts.",
+    ["path"],
+)
+RETRIES = counter(
+    "webhook_buffer_retries_total",
+    "Webhooks scheduled for a delayed retry.",
+    ["path"],
+)
+DEAD = counter(
+    "webhook_buffer_dead_total",
+    "Webhooks moved to the dead stream.",
+    ["path"],
+)
+FORWARD_SECONDS = histogram(
+    "webhook_buffer_forward_seconds",
+    "Time spent delivering one webhook.",
+    ["via"],
+)
+LAG_SECONDS = histogram(
+    "webhook_buffer_lag_seconds",
+    "Time from buffering a webhook to its successful delivery.",
+    ["path"],
+    buckets=LAG_BUCKETS,
+)
+
+
+def text(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return value
+
+
+class StreamCollector:
+    # Reads the buffer state from Redis at scrape time, so every endpoint
+    # process and worker reports the same numbers.
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+
+    def describe(self):
+        # Keeps registration from querying Redis.
+        return []
+
+    def collect(self):
+        shards = range(config.STREAM_SHARDS)
+        pipe = self.redis_client.pipeline(transaction=False)
+        for shard in shards:
+            stream = stream_name(shard)
+            pipe.xlen(stream)
+            pipe.xrange(stream, count=1)
+            pipe.zcard(retry_zset_name(shard))
+            pipe.xpending(stream, config.FORWARD_GROUP)
+        pipe.xlen(config.DEAD_STREAM)
+        # A missing stream group must not fail the whole scrape.
+        replies = [
+            None if isinstance(reply, Exception) else reply
+            for reply in pipe.execute(raise_on_error=False)
+        ]
+
+        length = GaugeMetricFamily(
+            "webhook_buffer_stream_length",
+            "Entries waiting in the stream, including the pending list.",
+            labels=["stream"],
+        )
+        age = GaugeMetricFamily(
+            "webhook_buffer_oldest_entry_age_seconds",
+            "Age of the oldest entry in the stream.",
+            labels=["stream"],
+        )
+        pending = GaugeMetricFamily(
+            "webhook_buffer_pending_entries",
+            "Entries delivered to a worker and not acknowledged yet.",
+            labels=["stream"],
+        )
+        retries = GaugeMetricFamily(
+            "webhook_buffer_scheduled_retries",
+            "Entries waiting for a delayed retry.",
+            labels=["stream"],
+        )
+        now = time.time()
+        for shard in shards:
+            stream = stream_name(shard)
+            stream_length, oldest, scheduled, summary = replies[
+                shard * 4:shard * 4 + 4
+            ]
+            length.add_metric([stream], stream_length or 0)
+            retries.add_metric([stream], scheduled or 0)
+            pending.add_metric([stream], summary["pending"] if summary else 0)
+            oldest_age = 0.0
+            if oldest:
+                oldest_ms = int(text(oldest[0][0]).split("-")[0])
+                oldest_age = max(0.0, now - oldest_ms / 1000.0)
+            age.add_metric([stream], oldest_age)
+
+        dead = GaugeMetricFamily(
+            "webhook_buffer_dead_length",
+            "Entries in the dead stream.",
+        )
+        dead.add_metric([], replies[-1] or 0)
+        return [length, age, pending, retries, dead]
+
+
+_collector = None
+
+
+def registry(redis_client):
+    # Gunicorn runs several endpoint processes; with PROMETHEUS_MULTIPROC_DIR
+    # set their counters are merged from the shared directory.
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        scrape_registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(scrape_registry)
+        scrape_registry.register(StreamCollector(redis_client))
+        return scrape_registry
+
+    global _collector
+    if _collector is None:
+        _collector = StreamCollector(redis_client)
+        prometheus_client.REGISTRY.register(_collector)
+    return prometheus_client.REGISTRY
+
+
+def render(redis_client):
+    body = prometheus_client.generate_latest(registry(redis_client))
+    return prometheus_client.CONTENT_TYPE_LATEST, body
+
+
+def start_server(redis_client):
+    prometheus_client.start_http_server(
+        config.METRICS_PORT,
+        registry=registry(redis_client),
+    )
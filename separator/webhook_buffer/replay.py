@@ -0,0 +1,212 @@
+import argparse
+import time
+from datetime import datetime, timezone
+
+import redis
+
+from . import config
+from .envelope import decode, text
+from .shards import shard_for, stream_name, tenant_key
+
+
+redis_client = redis.Redis.from_url(
+    config.REDIS_URL,
+    decode_responses=False,
+    socket_connect_timeout=config.REDIS_CONNECT_TIMEOUT,
+    socket_timeout=config.REDIS_SOCKET_TIMEOUT,
+)
+
+
+def parse_time(value):
+    try:
+        return float(value)
+    except ValueError:
+        moment = datetime.fromisoformat(value)
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+        return moment.timestamp()
+
+
+def parse_header(value):
+    name, _, expected = value.partition("=")
+    return name.strip().lower(), expected.strip()
+
+
+def iter_dead(page_size):
+    # Walks the dead stream page by page so it never has to fit in memory.
+    start = "-"
+    while True:
+        page = redis_client.xrange(config.DEAD_STREAM, min=start, count=page_size)
+        if not page:
+            return
+        for message_id, data in page:
+            fields = {key.decode(): value for key, value in data.items()}
+            yield text(message_id), fields
+        start = "(" + text(page[-1][0])
+
+
+def matches(args, data, entry):
+    if args.path and entry["path"] not in args.path:
+        return False
+    if args.tenant:
+        tenant = tenant_key(entry["path"], entry["query"], entry["body"])
+        if tenant != args.tenant:
+            return False
+
+    created_at = float(text(data.get("created_at")) or 0)
+    if args.since is not None and created_at < args.since:
+        return False
+    if args.until is not None and created_at >= args.until:
+        return False
+
+    headers = {name.lower(): value for name, value in entry["headers"].items()}
+    for name, expected in args.header:
+        if name not in headers or (expected and headers[name] != expected):
+            return False
+    return True
+
+
+def select(args):
+    found = 0
+    for message_id, data in iter_dead(args.page_size):
+        try:
+            entry = decode(data)
+        except Exception as exc:
+            print(f"{message_id} skipped: {exc}")
+            continue
+        if not matches(args, data, entry):
+            continue
+        yield message_id, data, entry
+        found += 1
+        if args.limit and found >= args.limit:
+            return
+
+
+def list_entries(args):
+    count = 0
+    for message_id, data, entry in select(args):
+        created_at = float(text(data.get("created_at")) or 0)
+        failed_at = float(text(data.get("failed_at")) or 0)
+        print(
+            message_id,
+            entry["path"],
+            tenant_key(entry["path"], entry["query"], entry["body"]),
+            datetime.fromtimestamp(created_at, timezone.utc).isoformat(),
+            datetime.fromtimestamp(failed_at, timezone.utc).isoformat(),
+            f"retries={text(data.get('retry_count')) or 0}",
+            f"bytes={len(entry['body'])}",
+        )
+        count += 1
+    print(f"{count} entries")
+
+
+def wait_for_backlog(batch, max_backlog):
+    if not max_backlog:
+        return
+    for stream in {stream for _, stream, _ in batch}:
+        while redis_client.xlen(stream) >= max_backlog:
+            time.sleep(1)
+
+
+def flush(batch, args):
+    if args.dry_run:
+        return
+    wait_for_backlog(batch, args.max_backlog)
+    pipe = redis_client.pipeline()
+    for message_id, stream, data in batch:
+        pipe.xadd(stream, data)
+        if not args.keep:
+            pipe.xdel(config.DEAD_STREAM, message_id)
+    pipe.execute()
+
+
+def replay(args):
+    count = 0
+    batch = []
+    started = time.monotonic()
+
+    for message_id, data, entry in select(args):
+        next_data = dict(data)
+        next_data.pop("failed_at", None)
+        next_data["retry_count"] = "0"
+        shard = shard_for(entry["path"], entry["query"], entry["body"])
+        stream = stream_name(shard)
+        batch.append((message_id, stream, next_data))
+        if len(batch) < args.batch_size:
+            continue
+
+        count += len(batch)
+        flush(batch, args)
+        batch = []
+        if args.rate and not args.dry_run:
+            # Keep the average replay speed at or below --rate entries/s.
+            delay = count / args.rate - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+
+    if batch:
+        count += len(batch)
+        flush(batch, args)
+
+    action = "Would replay" if args.dry_run else "Replayed"
+    print(f"{action} {count} entries")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="python3 -m separator.webhook_buffer.replay",
+        description="Inspect and replay entries of the webhook dead stream.",
+    )
+    parser.add_argument("command", choices=["list", "replay"])
+    parser.add_argument(
+        "--path", action="append", default=[], help="Only entries for this path."
+    )
+    parser.add_argument("--tenant", help="Only entries for this tenant key.")
+    parser.add_argument(
+        "--since",
+        type=parse_time,
+        help="Only entries buffered at or after this unix time or ISO date.",
+    )
+    parser.add_argument(
+        "--until",
+        type=parse_time,
+        help="Only entries buffered before this unix time or ISO date.",
+    )
+    parser.add_argument(
+        "--header",
+        action="append",
+        default=[],
+        type=parse_header,
+        help="Only entries with this header, as NAME or NAME=VALUE.",
+    )
+    parser.add_argument("--limit", type=int, default=0, help="Stop after N entries.")
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument(
+        "--rate", type=float, default=50.0, help="Maximum entries per second."
+    )
+    parser.add_argument(
+        "--max-backlog",
+        type=int,
+        default=1000,
+        help="Pause while the target stream holds this many entries.",
+    )
+    parser.add_argument(
+        "--keep",
+        action="store_true",
+        help="Keep replayed entries in the dead stream.",
+    )
+    parser.add_argument("--dry-run", action="store_true")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == "list":
+        list_entries(args)
+    else:
+        replay(args)
+
+
+if __name__ == "__main__":
+    main()
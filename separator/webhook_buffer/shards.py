@@ -0,0 +1,86 @@
+import json
+import re
+import zlib
+from urllib.parse import parse_qsl, unquote_plus
+
+from . import config
+
+
+BITRIX_TENANT_FIELDS = [
+    re.compile(rb"(?:^|&)auth(?:\[|%5B)member_id(?:\]|%5D)=([^&]*)", re.IGNORECASE),
+    re.compile(
+        rb"(?:^|&)auth(?:\[|%5B)application_token(?:\]|%5D)=([^&]*)",
+        re.IGNORECASE,
+    ),
+]
+
+
+def stream_name(shard):
+    if config.STREAM_SHARDS <= 1:
+        return config.STREAM
+    return f"{config.STREAM}:{shard}"
+
+
+def retry_zset_name(shard):
+    if config.STREAM_SHARDS <= 1:
+        return config.RETRY_ZSET
+    return f"{config.RETRY_ZSET}:{shard}"
+
+
+def worker_shards():
+    shards = []
+    for value in config.FORWARD_SHARDS.split(","):
+        value = value.strip()
+        if not value:
+            continue
+        try:
+            shard = int(value)
+        except ValueError:
+            continue
+        if 0 <= shard < config.STREAM_SHARDS and shard not in shards:
+            shards.append(shard)
+    return shards or list(range(config.STREAM_SHARDS))
+
+
+def bitrix_tenant_key(body):
+    # Bitrix posts form-encoded payloads; the auth fields are searched for
+    # directly instead of parsing the whole body.
+    for pattern in BITRIX_TENANT_FIELDS:
+        match = pattern.search(body)
+        if match and match.group(1):
+            return unquote_plus(match.group(1).decode("latin-1"))
+    return ""
+
+
+def waba_tenant_key(query, body):
+    # The WABA id is the tenant; app_id is shared by every WABA of a Meta app
+    # and is only used when the payload carries no entry id.
+    try:
+        entry = json.loads(body).get("entry") or [{}]
+        waba_id = str(entry[0].get("id") or "")
+    except (ValueError, AttributeError, IndexError, TypeError):
+        waba_id = ""
+    if waba_id:
+        return waba_id
+    for key, value in parse_qsl(query):
+        if key == "app_id" and value:
+            return value
+    return ""
+
+
+def tenant_key(path, query, body):
+    if path.startswith("/api/bitrix/"):
+        key = bitrix_tenant_key(body)
+    elif path.startswith("/api/waba/"):
+        key = waba_tenant_key(query, body)
+    else:
+        key = ""
+    # Entries without a tenant keep per-path ordering.
+    return key or path
+
+
+def shard_for(path, query, body):
+    if config.STREAM_SHARDS <= 1:
+        return 0
+    key = tenant_key(path, query, body)
+    return zlib.crc32(key.encode("utf-8")) % config.STREAM_SHARDS
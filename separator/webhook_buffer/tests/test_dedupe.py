@@ -0,0 +1,67 @@
+import io
+import json
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+from separator.webhook_buffer import config, wsgi  # noqa: E402
+from separator.webhook_buffer.dedupe import ADD_ONCE  # noqa: E402
+from separator.webhook_buffer.shards import stream_name  # noqa: E402
+
+
+@pytest.fixture()
+def redis_client(monkeypatch):
+    client = fakeredis.FakeRedis(decode_responses=True)
+    client.flushall()
+    monkeypatch.setattr(wsgi, "redis_client", client)
+    monkeypatch.setattr(wsgi, "add_once_script", client.register_script(ADD_ONCE))
+    monkeypatch.setattr(wsgi, "backlog_cache", wsgi.BacklogCache())
+    monkeypatch.setattr(config, "DEDUPE_TTL", 60)
+    return client
+
+
+def post(path, payload):
+    body = json.dumps(payload).encode()
+    environ = {
+        "REQUEST_METHOD": "POST",
+        "PATH_INFO": path,
+        "QUERY_STRING": "",
+        "CONTENT_LENGTH": str(len(body)),
+        "CONTENT_TYPE": "application/json",
+        "wsgi.input": io.BytesIO(body),
+    }
+    responses = []
+    output = wsgi.application(environ, lambda status, headers: responses.append(status))
+    return responses[0], b"".join(output)
+
+
+def waba_event(**value):
+    return {"entry": [{"id": "1", "changes": [{"value": value}]}]}
+
+
+def test_redelivered_message_is_answered_without_buffering(redis_client):
+    event = waba_event(messages=[{"id": "wamid.1", "text": {"body": "hi"}}])
+
+    assert post("/api/waba/", event) == ("202 Accepted", b"ok")
+    assert post("/api/waba/", event) == ("200 OK", b"duplicate")
+    assert redis_client.xlen(stream_name(0)) == 1
+
+
+def test_status_changes_of_a_message_are_not_duplicates(redis_client):
+    delivered = waba_event(statuses=[{"id": "wamid.1", "status": "delivered"}])
+    read = waba_event(statuses=[{"id": "wamid.1", "status": "read"}])
+
+    assert post("/api/waba/", delivered)[0] == "202 Accepted"
+    assert post("/api/waba/", read)[0] == "202 Accepted"
+    assert redis_client.xlen(stream_name(0)) == 2
+
+
+def test_without_ttl_every_delivery_is_buffered(monkeypatch, redis_client):
+    monkeypatch.setattr(config, "DEDUPE_TTL", 0)
+    event = waba_event(messages=[{"id": "wamid.1"}])
+
+    assert post("/api/waba/", event)[0] == "202 Accepted"
+    assert post("/api/waba/", event)[0] == "202 Accepted"
+    assert redis_client.xlen(stream_name(0)) == 2
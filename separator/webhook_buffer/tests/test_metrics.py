@@ -0,0 +1,31 @@
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+prometheus_client = pytest.importorskip("prometheus_client")
+pytest.importorskip("zstandard")
+
+from separator.webhook_buffer import config, envelope, metrics  # noqa: E402
+from separator.webhook_buffer.shards import stream_name  # noqa: E402
+
+
+@pytest.fixture()
+def redis_client():
+    return fakeredis.FakeRedis()
+
+
+def test_collector_reads_compressed_entries(monkeypatch, redis_client):
+    monkeypatch.setattr(config, "ENVELOPE", "binary")
+    monkeypatch.setattr(config, "COMPRESSION", "zstd")
+    monkeypatch.setattr(config, "COMPRESS_MIN_SIZE", 1)
+    message = envelope.encode("POST", "/api/bitrix/", "", {}, b"x" * 500, time.time())
+    assert message["encoding"] == "zstd"
+    redis_client.xadd(stream_name(0), message)
+
+    registry = prometheus_client.CollectorRegistry()
+    registry.register(metrics.StreamCollector(redis_client))
+    output = prometheus_client.generate_latest(registry).decode()
+
+    assert f'webhook_buffer_stream_length{{stream="{stream_name(0)}"}} 1.0' in output
+    assert "webhook_buffer_oldest_entry_age_seconds" in output
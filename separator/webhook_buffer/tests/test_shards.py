@@ -0,0 +1,46 @@
+import json
+import zlib
+
+import pytest
+
+from separator.webhook_buffer import config
+from separator.webhook_buffer.shards import shard_for, stream_name, tenant_key
+
+
+@pytest.fixture(autouse=True)
+def shards(monkeypatch):
+    monkeypatch.setattr(config, "STREAM_SHARDS", 8)
+
+
+def test_bitrix_events_of_a_portal_share_a_shard():
+    message = b"event=ONIMCONNECTORMESSAGEADD&auth[member_id]=abc123&auth[application_token]=t1"
+    status = b"event=ONIMCONNECTORSTATUSDELETE&auth%5Bmember_id%5D=abc123"
+
+    assert tenant_key("/api/bitrix/", "", message) == "abc123"
+    assert shard_for("/api/bitrix/", "", message) == zlib.crc32(b"abc123") % 8
+    assert shard_for("/api/bitrix/sms/", "", status) == shard_for("/api/bitrix/", "", message)
+
+
+def test_bitrix_falls_back_to_the_application_token():
+    body = b"event=ONAPPINSTALL&auth[application_token]=t1"
+
+    assert tenant_key("/api/bitrix/", "", body) == "t1"
+
+
+def test_waba_events_are_routed_by_waba_id():
+    body = json.dumps({"entry": [{"id": "1029384756"}]}).encode()
+
+    assert shard_for("/api/waba/", "app_id=1", body) == zlib.crc32(b"1029384756") % 8
+    assert tenant_key("/api/waba/", "app_id=77", b"not json") == "77"
+
+
+def test_entries_without_a_tenant_are_routed_by_path():
+    assert tenant_key("/api/olx/", "", b"{}") == "/api/olx/"
+    assert shard_for("/api/olx/", "", b"{}") == shard_for("/api/olx/", "", b"other")
+
+
+def test_stream_names(monkeypatch):
+    assert stream_name(3) == f"{config.STREAM}:3"
+    monkeypatch.setattr(config, "STREAM_SHARDS", 1)
+    assert stream_name(0) == config.STREAM
+    assert shard_for("/api/bitrix/", "", b"auth[member_id]=abc123") == 0
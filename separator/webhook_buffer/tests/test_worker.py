@@ -0,0 +1,72 @@
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+from separator.webhook_buffer import config, worker  # noqa: E402
+from separator.webhook_buffer.shards import retry_zset_name, stream_name  # noqa: E402
+
+
+@pytest.fixture()
+def redis_client(monkeypatch):
+    client = fakeredis.FakeRedis()
+    client.flushall()
+    monkeypatch.setattr(worker, "redis_client", client)
+    monkeypatch.setattr(
+        worker,
+        "move_due_retries_script",
+        client.register_script(worker.MOVE_DUE_RETRIES),
+    )
+    client.xgroup_create(stream_name(0), config.FORWARD_GROUP, id="0", mkstream=True)
+    return client
+
+
+def read_entry(redis_client):
+    stream, entries = redis_client.xreadgroup(
+        config.FORWARD_GROUP, "test", {stream_name(0): ">"}, count=1
+    )[0]
+    message_id, data = entries[0]
+    return worker.normalize(stream, message_id, data)
+
+
+def test_failed_entry_is_retried_through_the_schedule(monkeypatch, redis_client):
+    monkeypatch.setattr(config, "FORWARD_RETRY_DELAY", 0)
+    redis_client.xadd(stream_name(0), {"path": "/api/waba/", "body": b"{}"})
+    stream, message_id, data = read_entry(redis_client)
+
+    worker.ack_delete([(stream, message_id, data, False)])
+
+    assert redis_client.xlen(stream_name(0)) == 0
+    assert redis_client.zcard(retry_zset_name(0)) == 1
+    assert worker.move_due_retries() == 1
+    assert redis_client.zcard(retry_zset_name(0)) == 0
+    assert redis_client.keys(f"{retry_zset_name(0)}:*") == []
+
+    _, _, retried = read_entry(redis_client)
+    assert retried["retry_count"] == b"1"
+    assert retried["body"] == b"{}"
+
+
+def test_retry_waits_for_its_delay(monkeypatch, redis_client):
+    monkeypatch.setattr(config, "FORWARD_RETRY_DELAY", 60)
+    redis_client.xadd(stream_name(0), {"path": "/api/waba/", "body": b"{}"})
+
+    worker.ack_delete([(*read_entry(redis_client), False)])
+
+    assert worker.move_due_retries() == 0
+    assert redis_client.zcard(retry_zset_name(0)) == 1
+
+
+def test_entry_is_dead_lettered_after_max_retries(monkeypatch, redis_client):
+    monkeypatch.setattr(config, "FORWARD_MAX_RETRIES", 2)
+    redis_client.xadd(
+        stream_name(0), {"path": "/api/waba/", "body": b"{}", "retry_count": "2"}
+    )
+
+    worker.ack_delete([(*read_entry(redis_client), False)])
+
+    assert redis_client.xlen(stream_name(0)) == 0
+    assert redis_client.zcard(retry_zset_name(0)) == 0
+    [(_, dead)] = redis_client.xrange(config.DEAD_STREAM)
+    assert dead[b"retry_count"] == b"2"
+    assert b"failed_at" in dead
@@ -1,11 +1,15 @@
-import base64
-import json
 import logging
+import threading
 import time
+import uuid
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import zip_longest
 from urllib.parse import quote, urljoin
 
 import redis
 import requests
+from requests.adapters import HTTPAdapter
 
 try:
     import requests_unixsocket
@@ -13,6 +17,10 @@ except ImportError:
     requests_unixsocket = None
 
 from . import config
+from .dispatch import dispatch
+from . import metrics
+from .envelope import decode, text
+from .shards import retry_zset_name, stream_name, worker_shards
 
 
 logging.basicConfig(
@@ -21,26 +29,66 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# How long to block on XREADGROUP while forwards are still in flight, so
+# finished slots are refilled promptly.
+BUSY_BLOCK_MS = 100
+
+# Hop-by-hop headers of the buffered request. Replaying them (nginx sends
+# "Connection: close" to its upstreams) would defeat keep-alive reuse.
+HOP_BY_HOP_HEADERS = {
+    "Connection",
+    "Keep-Alive",
+    "Proxy-Connection",
+    "Te",
+    "Trailer",
+    "Transfer-Encoding",
+    "Upgrade",
+}
+
+# Maximum number of due retries moved back into the stream per poll.
+RETRY_MOVE_BATCH = 100
+
+# Atomically moves due retries from the schedule back into the stream.
+# Each ZSET member is the key of a hash holding the entry fields, so
+# several workers can run the mover without duplicating entries.
+MOVE_DUE_RETRIES = """
+local due = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1], "LIMIT", 0, ARGV[2])
+for _, key in ipairs(due) do
+    redis.call("ZREM", KEYS[1], key)
+    local fields = redis.call("HGETALL", key)
+    if #fields > 0 then
+        redis.call("XADD", KEYS[2], "*", unpack(fields))
+    end
+    redis.call("DEL", key)
+end
+return #due
+"""
+
 redis_client = redis.Redis.from_url(
     config.REDIS_URL,
-    decode_responses=True,
+    decode_responses=False,
     socket_connect_timeout=config.REDIS_CONNECT_TIMEOUT,
     socket_timeout=config.REDIS_SOCKET_TIMEOUT,
     health_check_interval=config.REDIS_HEALTH_CHECK_INTERVAL,
 )
+move_due_retries_script = redis_client.register_script(MOVE_DUE_RETRIES)
+
+# Shard streams consumed by this worker, mapped to their retry schedules.
+STREAMS = {stream_name(shard): retry_zset_name(shard) for shard in worker_shards()}
 
 
 def ensure_group():
-    try:
-        redis_client.xgroup_create(
-            config.STREAM,
-            config.FORWARD_GROUP,
-            id="0",
-            mkstream=True,
-        )
-    except redis.exceptions.ResponseError as exc:
-        if "BUSYGROUP" not in str(exc):
-            raise
+    for stream in STREAMS:
+        try:
+            redis_client.xgroup_create(
+                stream,
+                config.FORWARD_GROUP,
+                id="0",
+                mkstream=True,
+            )
+        except redis.exceptions.ResponseError as exc:
+            if "BUSYGROUP" not in str(exc):
+                raise
 
 
 def is_no_group_error(exc):
@@ -63,112 +111,300 @@ def build_unix_socket_url(path, query):
     return url
 
 
+_session = None
+_session_lock = threading.Lock()
+_local = threading.local()
+
+
+def create_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=config.FORWARD_POOL_SIZE,
+        max_retries=0,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
 def get_session():
-    if not config.FORWARD_UNIX_SOCKET:
-        return requests
-    if requests_unixsocket is None:
-        raise RuntimeError("requests-unixsocket is required for unix socket forwarding")
-    return requests_unixsocket.Session()
+    global _session
+
+    if config.FORWARD_UNIX_SOCKET:
+        if requests_unixsocket is None:
+            raise RuntimeError(
+                "requests-unixsocket is required for unix socket forwarding"
+            )
+        # UnixAdapter keeps a single connection per pool, so each forwarding
+        # thread holds its own keep-alive session.
+        session = getattr(_local, "session", None)
+        if session is None:
+            session = _local.session = requests_unixsocket.Session()
+        return session
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session()
+    return _session
 
 
 def forward(data):
-    body = base64.b64decode(data["body"])
-    headers = json.loads(data.get("headers") or "{}")
+    entry = decode(data)
+    if config.DISPATCH_MODE == "celery":
+        try:
+            if dispatch(entry):
+                return "celery"
+        except Exception:
+            logger.exception("Direct dispatch failed, forwarding over HTTP")
+
+    headers = entry["headers"]
     headers.pop("Content-Length", None)
+    for header in HOP_BY_HOP_HEADERS:
+        headers.pop(header, None)
     headers["X-Webhook-Buffered"] = "1"
 
     session = get_session()
     url = (
-        build_unix_socket_url(data["path"], data.get("query") or "")
+        build_unix_socket_url(entry["path"], entry["query"])
         if config.FORWARD_UNIX_SOCKET
-        else build_url(data["path"], data.get("query") or "")
+        else build_url(entry["path"], entry["query"])
     )
 
     response = session.request(
-        method=data["method"],
+        method=entry["method"],
         url=url,
-        data=body,
+        data=entry["body"],
         headers=headers,
         timeout=config.FORWARD_TIMEOUT,
     )
     response.raise_for_status()
+    return "http"
 
 
-def ack_delete(message_id):
-    pipe = redis_client.pipeline()
-    pipe.xack(config.STREAM, config.FORWARD_GROUP, message_id)
-    pipe.xdel(config.STREAM, message_id)
-    pipe.execute()
-
-
-def requeue_or_dead(message_id, data):
+def requeue_or_dead(pipe, stream, message_id, data):
     retry_count = int(data.get("retry_count") or 0) + 1
     next_data = dict(data)
 
     if retry_count > config.FORWARD_MAX_RETRIES:
         next_data["failed_at"] = str(time.time())
-        redis_client.xadd(config.DEAD_STREAM, next_data)
-        ack_delete(message_id)
-        logger.error("Moved webhook %s to dead stream", message_id)
+        pipe.xadd(config.DEAD_STREAM, next_data)
+        metrics.DEAD.labels(text(data.get("path"))).inc()
+        logger.error("Moving webhook %s to dead stream", message_id)
         return
 
     next_data["retry_count"] = str(retry_count)
-    time.sleep(min(60.0, retry_count * config.FORWARD_RETRY_DELAY))
-    redis_client.xadd(config.STREAM, next_data)
-    ack_delete(message_id)
+    delay = min(
+        config.FORWARD_RETRY_MAX_DELAY,
+        retry_count * config.FORWARD_RETRY_DELAY,
+    )
+    retry_zset = STREAMS[stream]
+    key = f"{retry_zset}:{uuid.uuid4().hex}"
+    pipe.hset(key, mapping=next_data)
+    pipe.zadd(retry_zset, {key: time.time() + delay})
+    metrics.RETRIES.labels(text(data.get("path"))).inc()
+    logger.info(
+        "Scheduling webhook %s retry %s in %.1fs", message_id, retry_count, delay
+    )
+
+
+def ack_delete(results):
+    # Settles a batch of (stream, message_id, data, ok) results in one MULTI
+    # round trip: failed entries are scheduled for retry or moved to the dead
+    # stream, then each stream's entries are acked and deleted with one
+    # XACK/XDEL.
+    pipe = redis_client.pipeline()
+    message_ids = {}
+    for stream, message_id, data, ok in results:
+        if not ok:
+            requeue_or_dead(pipe, stream, message_id, data)
+        message_ids.setdefault(stream, []).append(message_id)
+    for stream, ids in message_ids.items():
+        pipe.xack(stream, config.FORWARD_GROUP, *ids)
+        pipe.xdel(stream, *ids)
+    pipe.execute()
+
+
+def move_due_retries():
+    pipe = redis_client.pipeline(transaction=False)
+    for stream, retry_zset in STREAMS.items():
+        move_due_retries_script(
+            keys=[retry_zset, stream],
+            args=[time.time(), RETRY_MOVE_BATCH],
+            client=pipe,
+        )
+    return sum(pipe.execute())
 
 
-def process_entry(message_id, data):
+def process_entry(stream, message_id, data):
+    path = text(data.get("path"))
+    started = time.monotonic()
     try:
-        forward(data)
+        via = forward(data)
     except Exception:
-        logger.exception("Failed to forward webhook %s", message_id)
-        requeue_or_dead(message_id, data)
-        return
-
-    ack_delete(message_id)
-    logger.info("Forwarded webhook %s", message_id)
+        logger.exception(
+            "Failed to forward webhook %s after %.1f ms",
+            message_id,
+            (time.monotonic() - started) * 1000,
+        )
+        metrics.FORWARD_FAILURES.labels(path).inc()
+        return stream, message_id, data, False
+
+    elapsed = time.monotonic() - started
+    logger.info(
+        "Forwarded webhook %s via %s in %.1f ms",
+        message_id,
+        via,
+        elapsed * 1000,
+    )
+    metrics.FORWARDED.labels(path, via).inc()
+    metrics.FORWARD_SECONDS.labels(via).observe(elapsed)
+    try:
+        metrics.LAG_SECONDS.labels(path).observe(
+            max(0.0, time.time() - float(data.get("created_at") or 0))
+        )
+    except ValueError:
+        pass
+    return stream, message_id, data, True
+
+
+def normalize(stream, message_id, data):
+    # The client returns raw bytes so binary envelopes survive untouched;
+    # only the stream name, entry id and field names are decoded.
+    return (
+        stream.decode() if isinstance(stream, bytes) else stream,
+        message_id.decode() if isinstance(message_id, bytes) else message_id,
+        {key.decode(): value for key, value in data.items()},
+    )
 
 
-def claim_pending():
+def claim_pending(stream, start_id, count):
     result = redis_client.xautoclaim(
-        config.STREAM,
+        stream,
         config.FORWARD_GROUP,
         config.FORWARD_CONSUMER,
         min_idle_time=config.FORWARD_PENDING_IDLE_MS,
-        start_id="0-0",
-        count=config.FORWARD_BATCH_SIZE,
+        start_id=start_id,
+        count=count,
     )
     if len(result) == 3:
-        _, messages, _ = result
+        next_id, messages, _ = result
     else:
-        _, messages = result
-    return messages
-
-
-def read_new_messages():
-    return redis_client.xreadgroup(
+        next_id, messages = result
+    return next_id, [
+        normalize(stream, message_id, data)
+        for message_id, data in messages
+        if data is not None
+    ]
+
+
+def read_new_messages(streams, count, block):
+    # Every shard contributes up to its share of the batch, and the entries
+    # are interleaved so no shard is drained ahead of the others.
+    per_stream = max(1, -(-count // len(streams)))
+    response = redis_client.xreadgroup(
         config.FORWARD_GROUP,
         config.FORWARD_CONSUMER,
-        {config.STREAM: ">"},
-        count=config.FORWARD_BATCH_SIZE,
-        block=config.FORWARD_BLOCK_MS,
+        {stream: ">" for stream in streams},
+        count=per_stream,
+        block=block,
     )
+    batches = [
+        [normalize(stream, message_id, data) for message_id, data in entries]
+        for stream, entries in response or []
+    ]
+    return [entry for row in zip_longest(*batches) for entry in row if entry]
+
+
+def reap(in_flight, results):
+    for future in [future for future in in_flight if future.done()]:
+        stream, message_id = in_flight.pop(future)
+        exc = future.exception()
+        if exc is not None:
+            # The entry stays in the PEL and is reclaimed by claim_pending().
+            logger.error(
+                "Webhook forward task failed for %s", message_id, exc_info=exc
+            )
+            continue
+        results.append(future.result())
 
 
 def main():
     ensure_group()
-    logger.info("Webhook forward worker started")
+    if config.METRICS_PORT:
+        metrics.start_server(redis_client)
+    logger.info(
+        "Webhook forward worker started with concurrency %s on %s",
+        config.FORWARD_CONCURRENCY,
+        ", ".join(STREAMS),
+    )
+
+    executor = ThreadPoolExecutor(
+        max_workers=config.FORWARD_CONCURRENCY,
+        thread_name_prefix="webhook-forward",
+    )
+    streams = list(STREAMS)
+    in_flight = {}
+    # Entries read from Redis and waiting for a free forwarding slot.
+    backlog = deque()
+    # Processed entries waiting to be acked in the next batch round trip.
+    results = []
+    next_retry_poll = 0.0
+    next_claim = 0.0
+    claim_start_ids = dict.fromkeys(streams, "0-0")
 
     while True:
+        reap(in_flight, results)
+        while backlog and len(in_flight) < config.FORWARD_CONCURRENCY:
+            stream, message_id, data = backlog.popleft()
+            future = executor.submit(process_entry, stream, message_id, data)
+            in_flight[future] = (stream, message_id)
+
         try:
-            pending_messages = claim_pending()
-            if pending_messages:
-                for message_id, data in pending_messages:
-                    process_entry(message_id, data)
+            batch_full = len(results) >= config.FORWARD_BATCH_SIZE
+            if results and (batch_full or not backlog):
+                ack_delete(results)
+                results = []
+
+            if len(in_flight) >= config.FORWARD_CONCURRENCY:
+                wait(in_flight, return_when=FIRST_COMPLETED)
                 continue
 
-            messages = read_new_messages()
+            now = time.monotonic()
+            if now >= next_retry_poll:
+                move_due_retries()
+                next_retry_poll = now + config.FORWARD_RETRY_POLL_MS / 1000.0
+
+            messages = []
+            if now >= next_claim:
+                for stream in streams:
+                    claim_start_ids[stream], claimed = claim_pending(
+                        stream, claim_start_ids[stream], config.FORWARD_BATCH_SIZE
+                    )
+                    messages.extend(claimed)
+                if all(
+                    start_id in ("0-0", b"0-0")
+                    for start_id in claim_start_ids.values()
+                ):
+                    # The PEL scan is complete; wait for the next interval.
+                    next_claim = now + config.FORWARD_CLAIM_INTERVAL_MS / 1000.0
+                running = set(in_flight.values())
+                running.update(entry[:2] for entry in backlog)
+                running.update(result[:2] for result in results)
+                messages = [
+                    (stream, message_id, data)
+                    for stream, message_id, data in messages
+                    if (stream, message_id) not in running
+                ]
+
+            if not messages:
+                block = BUSY_BLOCK_MS if in_flight else min(
+                    config.FORWARD_BLOCK_MS, config.FORWARD_RETRY_POLL_MS
+                )
+                messages = read_new_messages(streams, config.FORWARD_BATCH_SIZE, block)
+                # Rotate the shard order so every shard gets to go first.
+                streams.append(streams.pop(0))
         except redis.exceptions.TimeoutError:
             continue
         except redis.exceptions.ConnectionError:
@@ -182,9 +418,7 @@ def main():
             ensure_group()
             continue
 
-        for _, entries in messages:
-            for message_id, data in entries:
-                process_entry(message_id, data)
+        backlog.extend(messages)
 
 
 if __name__ == "__main__":
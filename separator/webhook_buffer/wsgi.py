@@ -1,23 +1,57 @@
-import base64
-import json
-import time
-from urllib.parse import parse_qsl
-
 import redis
+from redis.client import NEVER_DECODE
 
-from . import config
+from . import config, metrics
+from .dedupe import ADD_ONCE, add_args, event_key
+from .ingress import (
+    BacklogCache,
+    accepts,
+    build,
+    headers_from_environ,
+    is_metrics_request,
+    is_overloaded,
+    response,
+)
 
 
 redis_client = redis.Redis.from_url(config.REDIS_URL, decode_responses=True)
+# Scrapes read stream entries, which are not UTF-8 when compressed.
+metrics_client = redis.Redis.from_url(config.REDIS_URL)
+add_once_script = redis_client.register_script(ADD_ONCE)
+backlog_cache = BacklogCache()
+
+
+def get_backlog(stream):
+    backlog = backlog_cache.get(stream)
+    if backlog is not None:
+        return backlog
+
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.xlen(stream)
+    # Raw bytes: a compressed binary envelope is not valid UTF-8, and only
+    # the entry id is needed.
+    pipe.execute_command("XRANGE", stream, "-", "+", "COUNT", 1, **{NEVER_DECODE: True})
+    length, oldest = pipe.execute()
+    return backlog_cache.update(stream, length, oldest)
+
+
+def reply(start_response, result):
+    status, headers, body = result
+    start_response(status, headers)
+    return [body]
 
 
 def application(environ, start_response):
     method = environ.get("REQUEST_METHOD", "")
     path = environ.get("PATH_INFO", "")
 
-    if method != "POST" or path not in config.PATHS:
-        start_response("404 Not Found", [("Content-Type", "text/plain")])
-        return [b"not found"]
+    if is_metrics_request(method, path):
+        content_type, output = metrics.render(metrics_client)
+        start_response("200 OK", [("Content-Type", content_type)])
+        return [output]
+
+    if not accepts(method, path):
+        return reply(start_response, response(path, "not_found"))
 
     try:
         content_length = int(environ.get("CONTENT_LENGTH") or 0)
@@ -26,34 +60,34 @@ def application(environ, start_response):
 
     body = environ["wsgi.input"].read(content_length)
     query = environ.get("QUERY_STRING", "")
-
-    headers = {}
-    for key, value in environ.items():
-        if key.startswith("HTTP_"):
-            header = key[5:].replace("_", "-").title()
-            headers[header] = value
-    if environ.get("CONTENT_TYPE"):
-        headers["Content-Type"] = environ["CONTENT_TYPE"]
-    if environ.get("CONTENT_LENGTH"):
-        headers["Content-Length"] = environ["CONTENT_LENGTH"]
-
-    message = {
-        "method": method,
-        "path": path,
-        "query": query,
-        "query_params": json.dumps(parse_qsl(query, keep_blank_values=True)),
-        "headers": json.dumps(headers),
-        "body": base64.b64encode(body).decode("ascii"),
-        "created_at": str(time.time()),
-        "retry_count": "0",
-    }
+    headers = headers_from_environ(environ)
+    stream, message = build(method, path, query, headers, body)
 
     try:
-        redis_client.xadd(config.STREAM, message)
+        backlog = get_backlog(stream)
     except Exception:
-        start_response("503 Service Unavailable", [("Content-Type", "text/plain")])
-        return [b"redis unavailable"]
+        backlog = (0, 0.0)
+
+    if is_overloaded(backlog):
+        return reply(start_response, response(path, "shed", backlog))
 
-    start_response("202 Accepted", [("Content-Type", "text/plain")])
-    return [b"ok"]
+    try:
+        if config.DEDUPE_TTL:
+            added = add_once_script(
+                keys=[stream, event_key(path, query, body)],
+                args=add_args(message),
+            )
+        else:
+            added = redis_client.xadd(
+                stream,
+                message,
+                maxlen=config.STREAM_MAXLEN or None,
+                approximate=True,
+            )
+    except Exception:
+        return reply(start_response, response(path, "error"))
 
+    if not added:
+        # Already buffered: acknowledge the redelivery without storing it.
+        return reply(start_response, response(path, "duplicate", backlog))
+    return reply(start_response, response(path, "accepted", backlog))